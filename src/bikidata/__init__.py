@@ -7,22 +7,22 @@ from .main import (
     log,
 )
 
-try:
-    from .semantic import build_semantic
-except:
-    log.warning(
-        "Failed to import build_semantic. "
-        "Make sure you have the required dependencies installed and COHERE_API_KEY env var defined."
-    )
+from .semantic import build_semantic, set_embedder
 
 from .query import (
     spo,
+    spo_page,
     sp,
     query,
+    query_iter,
     raw,
     total,
     count_by_property,
     properties,
 )
 
+from .export import export_query
+
+from .ivf import build_semantic_index
+
 from .workers import query_async, insert_async, delete_async, TimeoutError
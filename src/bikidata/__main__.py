@@ -4,26 +4,87 @@ from .workers import worker_main
 
 
 def check_suffix(filename):
-    for suffix in (".gz", ".nt", ".trig"):
+    for suffix in (".gz", ".bz2", ".xz", ".zst", ".nt", ".trig"):
         if filename.endswith(suffix):
             return True
     return False
 
 
-if sys.argv[1] == "worker":
-    num_workers = 1
-    if len(sys.argv) > 2:
-        try:
-            num_workers = int(sys.argv[2])
-        except:
-            num_workers = 1
-    worker_main(num_workers)
-    sys.exit(0)
-
-if check_suffix(sys.argv[1]):
-    build([sys.argv[1]])
-else:
-    filepaths = [
-        os.path.join(sys.argv[1], x) for x in os.listdir(sys.argv[1]) if check_suffix(x)
-    ]
-    build(filepaths)
+def pop_option(args: list, name: str, default=None):
+    "Remove a '--name value' pair from args, and return the value"
+    if name in args:
+        idx = args.index(name)
+        value = args[idx + 1] if idx + 1 < len(args) else default
+        del args[idx : idx + 2]
+        return value
+    return default
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+
+    if args[0] == "worker":
+        num_workers = 1
+        if len(args) > 1:
+            try:
+                num_workers = int(args[1])
+            except:
+                num_workers = 1
+        worker_main(num_workers)
+        sys.exit(0)
+
+    if args[0] == "export-parquet":
+        from .parquet import export_parquet
+
+        partitions = pop_option(args, "--partitions")
+        print(export_parquet(args[1], partitions=partitions and int(partitions)))
+        sys.exit(0)
+
+    if args[0] in ("index-dump", "map-dump"):
+        from .dumps import index_dump, map_dump
+
+        options = {"out_path": pop_option(args, "--out", "raw")}
+        shards = pop_option(args, "--shards")
+        if shards and args[0] == "map-dump":
+            options["shards"] = int(shards)
+        dump_workers = pop_option(args, "--workers")
+        if dump_workers:
+            options["workers"] = int(dump_workers)
+        row_group_size = pop_option(args, "--row-group-size")
+        if row_group_size:
+            options["row_group_size"] = int(row_group_size)
+        chunk_size = pop_option(args, "--chunk-size")
+        if chunk_size:
+            options["chunk_size"] = int(chunk_size) * 1024 * 1024
+        if args[0] == "map-dump":
+            print(map_dump(args[1:], **options))
+        else:
+            print(index_dump(args[1:], **options))
+        sys.exit(0)
+
+    workers = int(pop_option(args, "--workers", os.getenv("BIKIDATA_WORKERS", 1)))
+    mode = "create"
+    if "--append" in args:
+        args.remove("--append")
+        mode = "append"
+    resume = "--resume" in args
+    if resume:
+        args.remove("--resume")
+    # The defaults come from the BIKIDATA_MEMORY_LIMIT etc. environment variables
+    budget = {
+        "memory_limit": pop_option(args, "--memory-limit"),
+        "threads": pop_option(args, "--threads"),
+        "temp_directory": pop_option(args, "--temp-directory"),
+        "partitions": pop_option(args, "--partitions"),
+    }
+    if "--dense-ids" in args:
+        args.remove("--dense-ids")
+        budget["dense_ids"] = True
+
+    if check_suffix(args[0]):
+        build([args[0]], workers=workers, mode=mode, resume=resume, **budget)
+    else:
+        filepaths = [
+            os.path.join(args[0], x) for x in os.listdir(args[0]) if check_suffix(x)
+        ]
+        build(filepaths, workers=workers, mode=mode, resume=resume, **budget)
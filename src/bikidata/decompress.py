@@ -0,0 +1,174 @@
+import os, io, gzip, bz2, lzma, queue, shutil, subprocess, threading, logging
+
+log = logging.getLogger("bikidata")
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSED_SUFFIXES = (".gz", ".bz2", ".xz", ".zst")
+
+# Decompressor programs per format, the first one that is installed is used.
+# pigz and lbzip2/pbzip2 decompress on several cores, bz2 blocks are independent.
+# xz only decompresses in parallel files that were written in blocks (xz -T), like the dumps.
+EXTERNAL_DECOMPRESSORS = {
+    ".gz": (["pigz", "-dc"], ["gzip", "-dc"]),
+    ".bz2": (["lbzip2", "-dc"], ["pbzip2", "-dc"], ["bzip2", "-dc"]),
+    ".xz": (["xz", "-dc", "-T0"],),
+    ".zst": (["zstd", "-dc", "-q"],),
+}
+# Set to "internal" to decompress with the Python modules, in a thread, instead of a process
+BIKIDATA_DECOMPRESSOR = os.getenv("BIKIDATA_DECOMPRESSOR", "external")
+# The reader thread keeps up to READ_AHEAD blocks of READ_AHEAD_BLOCK bytes ready
+READ_AHEAD_BLOCK = 4 * 1024 * 1024
+READ_AHEAD = 8
+
+
+def compression_suffix(path: str):
+    for suffix in COMPRESSED_SUFFIXES:
+        if str(path).endswith(suffix):
+            return suffix
+    return None
+
+
+def strip_compression_suffix(path: str):
+    "myfile.trig.gz -> myfile.trig"
+    suffix = compression_suffix(path)
+    return str(path)[: -len(suffix)] if suffix else str(path)
+
+
+class BackgroundReader:
+    """
+    A read-only binary file that reads source in a background thread, some blocks ahead
+    of the consumer. The decompression, in the process that writes to source or in the
+    gzip/bz2/lzma modules that release the GIL, then runs in parallel with the parsing.
+    Only forward seeks are possible, they read up to the offset.
+    """
+
+    def __init__(self, source, name: str, process=None):
+        self.source = source
+        self.name = name
+        self.process = process
+        self.queue = queue.Queue(maxsize=READ_AHEAD)
+        self.buffer = b""
+        self.position = 0
+        self.done = False
+        self.closed = False
+        self.thread = threading.Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def fill(self):
+        try:
+            while not self.closed:
+                block = self.source.read(READ_AHEAD_BLOCK)
+                self.put(block)
+                if not block:
+                    break
+        except Exception as e:
+            self.put(e)
+
+    def check_process(self):
+        if self.process is None:
+            return
+        returncode = self.process.wait()
+        if returncode != 0:
+            raise IOError(
+                f"{' '.join(self.process.args)} exited with {returncode}, is {self.name} complete?"
+            )
+
+    def read(self, size: int = -1):
+        chunks = [self.buffer]
+        have = len(self.buffer)
+        while not self.done and (size < 0 or have < size):
+            item = self.queue.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                self.done = True
+                self.check_process()
+                break
+            chunks.append(item)
+            have += len(item)
+        data = b"".join(chunks)
+        if size < 0:
+            self.buffer = b""
+        else:
+            data, self.buffer = data[:size], data[size:]
+        self.position += len(data)
+        return data
+
+    def seek(self, offset: int, whence: int = 0):
+        if whence == 1:
+            offset += self.position
+        if whence == 2 or offset < self.position:
+            raise io.UnsupportedOperation(f"{self.name} can only seek forward")
+        while self.position < offset:
+            if not self.read(min(offset - self.position, READ_AHEAD_BLOCK)):
+                break
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_internal(path: str, suffix: str):
+    if suffix == ".gz":
+        return gzip.open(path, "rb")
+    if suffix == ".bz2":
+        return bz2.open(path, "rb")
+    if suffix == ".xz":
+        return lzma.open(path, "rb")
+    if zstandard is None:
+        raise ImportError(
+            f"Reading {path} needs the zstd program or the zstandard package, pip install zstandard"
+        )
+    return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+
+
+def open_input(path: str):
+    """
+    Open path for reading as binary, decompressing .gz, .bz2, .xz and .zst files.
+    Decompression runs in a separate process when a decompressor program is installed,
+    see EXTERNAL_DECOMPRESSORS, otherwise in a thread.
+    """
+    suffix = compression_suffix(path)
+    if suffix is None:
+        return open(path, "rb")
+    if BIKIDATA_DECOMPRESSOR != "internal":
+        for command in EXTERNAL_DECOMPRESSORS[suffix]:
+            if shutil.which(command[0]):
+                log.debug(f"Decompressing {path} with {command[0]}")
+                process = subprocess.Popen(
+                    command + [str(path)],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                )
+                return BackgroundReader(process.stdout, str(path), process)
+    return BackgroundReader(open_internal(path, suffix), str(path))
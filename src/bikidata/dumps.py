@@ -0,0 +1,414 @@
+import os, glob, shutil, time, queue
+import multiprocessing as mp
+import duckdb
+import numpy as np
+import pandas as pd
+from .main import log, align_offset
+from .metrics import BuildMetrics
+from .staging import H, BIKIDATA_DEDUP_MEMORY, BIKIDATA_STAGING_BATCH, SEEN_ENTRY_BYTES
+from .parquet import BIKIDATA_ROW_GROUP_SIZE
+from .decompress import COMPRESSED_SUFFIXES, open_input, strip_compression_suffix
+from .ntriples import READ_SIZE, iter_line_batches, new_stats, tokenize_lines
+
+# Seconds between the progress reports of a dump run
+DUMP_REPORT_INTERVAL = 30
+# Blocks waiting for a worker, per worker, more only costs memory
+DUMP_QUEUE_DEPTH = 2
+# Number of hash ranges the term map is split in, each is de-duplicated by its own process
+BIKIDATA_MAP_SHARDS = int(os.getenv("BIKIDATA_MAP_SHARDS", 16))
+
+
+def dump_tasks(triplefile_paths: list, chunk_size: int):
+    """
+    Yield the work for the dump workers: plain files as (path, start, end) byte ranges
+    the workers read themselves, compressed files as blocks of complete lines, read
+    and decompressed here. Either way a worker gets chunk_size bytes at a time, not lines.
+    """
+    for triplefile_path in triplefile_paths:
+        if str(triplefile_path).endswith(COMPRESSED_SUFFIXES):
+            with open_input(triplefile_path) as thefile:
+                yield from iter_line_batches(thefile, read_size=chunk_size)
+            continue
+        size = os.path.getsize(triplefile_path)
+        for start in range(0, size, chunk_size):
+            yield (str(triplefile_path), start, min(start + chunk_size, size))
+
+
+def task_blocks(task):
+    if isinstance(task, bytes):
+        yield task
+        return
+    triplefile_path, start, end = task
+    with open(triplefile_path, "rb") as thefile:
+        offset = align_offset(thefile, start)
+        limit = align_offset(thefile, end) - offset
+        thefile.seek(offset)
+        yield from iter_line_batches(thefile, limit=limit)
+
+
+def index_worker(
+    number: int,
+    tasks,
+    results,
+    lines_done,
+    out_path: str,
+    prefix: str,
+    row_group_size: int,
+    batch_size: int,
+):
+    """
+    Hash the triples of the tasks until a None arrives, writing them in batches of
+    batch_size rows to <prefix>-<number>-<seq>.parquet files with (s, p, o, g) ubigint columns.
+    """
+    con = duckdb.connect()
+    stats = new_stats()
+    files = []
+    s, p, o, g = [], [], [], []
+
+    def flush():
+        if not s:
+            return
+        out_file = os.path.join(
+            out_path, f"{prefix}-{number:02d}-{len(files):05d}.parquet"
+        )
+        hashed = pd.DataFrame(
+            {
+                "s": np.array(s, dtype=np.uint64),
+                "p": np.array(p, dtype=np.uint64),
+                "o": np.array(o, dtype=np.uint64),
+                "g": np.array(g, dtype=np.uint64),
+            }
+        )
+        con.register("hashed", hashed)
+        con.execute(
+            f"copy hashed to '{out_file}' (format parquet, compression zstd, row_group_size {int(row_group_size)})"
+        )
+        con.unregister("hashed")
+        files.append(out_file)
+        for column in (s, p, o, g):
+            column.clear()
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        for block in task_blocks(task):
+            lines_before = stats["lines"]
+            for ss, pp, oo, gg in tokenize_lines((block,), stats):
+                try:
+                    hashes = H(ss), H(pp), H(oo), H(gg)
+                except UnicodeEncodeError as e:
+                    log.error(f"Error hashing {e}")
+                    continue
+                s.append(hashes[0])
+                p.append(hashes[1])
+                o.append(hashes[2])
+                g.append(hashes[3])
+            if len(s) >= batch_size:
+                flush()
+            with lines_done.get_lock():
+                lines_done.value += stats["lines"] - lines_before
+    flush()
+    con.close()
+    results.put({"worker": number, "files": files, **stats})
+
+
+def shard_bounds(shards: int):
+    "The lower bounds of shards 1.., the same contiguous slices of the hash space as hash_slices()"
+    return np.array([i * 2**64 // shards for i in range(1, shards)], dtype=np.uint64)
+
+
+def map_worker(
+    number: int,
+    tasks,
+    results,
+    lines_done,
+    spill_path: str,
+    shards: int,
+    batch_size: int,
+    dedup_memory: int,
+):
+    """
+    Collect the terms of the tasks until a None arrives, and spill them in batches to
+    <spill_path>/<number>/shard=<n>/*.parquet, split by the hash range they fall in.
+    Terms this worker has already spilled are skipped, while they fit in dedup_memory MB,
+    the exact de-duplication happens per shard in merge_shard().
+    """
+    con = duckdb.connect()
+    stats = new_stats()
+    bounds = shard_bounds(shards)
+    worker_path = os.path.join(spill_path, f"{number:02d}")
+    os.makedirs(worker_path, exist_ok=True)
+    seen = set()
+    max_seen = max(1, dedup_memory * 1024 * 1024 // SEEN_ENTRY_BYTES)
+    hashes, values = [], []
+    spilled = 0
+
+    def flush():
+        nonlocal spilled
+        if not hashes:
+            return
+        term_hashes = np.array(hashes, dtype=np.uint64)
+        terms = pd.DataFrame(
+            {
+                "shard": np.searchsorted(bounds, term_hashes, side="right"),
+                "hash": term_hashes,
+                "value": values,
+            }
+        )
+        con.register("terms", terms)
+        con.execute(
+            f"copy terms to '{worker_path}' (format parquet, compression zstd, partition_by (shard), append, filename_pattern 'terms-{{uuid}}')"
+        )
+        con.unregister("terms")
+        spilled += len(hashes)
+        hashes.clear()
+        values.clear()
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        for block in task_blocks(task):
+            lines_before = stats["lines"]
+            for terms in tokenize_lines((block,), stats):
+                for term in terms:
+                    try:
+                        term_hash = H(term)
+                    except UnicodeEncodeError as e:
+                        log.error(f"Error hashing {e}")
+                        continue
+                    if term_hash in seen:
+                        continue
+                    if len(seen) >= max_seen:
+                        seen.clear()
+                    seen.add(term_hash)
+                    hashes.append(term_hash)
+                    values.append(term)
+            if len(hashes) >= batch_size:
+                flush()
+            with lines_done.get_lock():
+                lines_done.value += stats["lines"] - lines_before
+    flush()
+    con.close()
+    results.put({"worker": number, "terms": spilled, **stats})
+
+
+def merge_shard(task):
+    "De-duplicate the spilled terms of one shard, into a single file sorted by hash"
+    shard, spill_path, out_file, row_group_size = task
+    spilled = glob.glob(os.path.join(spill_path, "*", f"shard={shard}", "*.parquet"))
+    con = duckdb.connect()
+    con.execute("SET preserve_insertion_order = false")
+    if spilled:
+        source = f"read_parquet([{', '.join(repr(x) for x in spilled)}], hive_partitioning = false)"
+    else:
+        source = "(select 0::ubigint as hash, ''::varchar as value where false)"
+    con.execute(
+        f"""copy (select hash, min(value) as value from {source} group by hash order by hash)
+        to '{out_file}' (format parquet, compression zstd, row_group_size {int(row_group_size)})"""
+    )
+    count = con.execute(f"select count(*) from read_parquet('{out_file}')").fetchone()[0]
+    con.close()
+    return count
+
+
+def check_workers(workers: list):
+    for worker in workers:
+        if worker.exitcode not in (None, 0):
+            raise RuntimeError(
+                f"Dump worker {worker.name} exited with {worker.exitcode}"
+            )
+
+
+def run_dump(
+    phase: str,
+    target,
+    args: tuple,
+    triplefile_paths: list,
+    workers: int,
+    chunk_size: int,
+    metrics: BuildMetrics,
+):
+    """
+    Run target(number, tasks, results, lines_done, *args) in workers processes over the
+    chunks of triplefile_paths, and return the dicts they put in results when done.
+    The aggregate lines/sec is logged, and emitted as progress of phase, as it goes.
+    """
+    start_time = time.time()
+    tasks = mp.Queue(maxsize=workers * DUMP_QUEUE_DEPTH)
+    results = mp.Queue()
+    lines_done = mp.Value("q", 0)
+    processes = []
+    for number in range(workers):
+        worker = mp.Process(
+            target=target,
+            daemon=True,
+            args=(number, tasks, results, lines_done) + args,
+        )
+        worker.start()
+        processes.append(worker)
+
+    report_time = time.time()
+
+    def report():
+        nonlocal report_time
+        if time.time() - report_time < DUMP_REPORT_INTERVAL:
+            return
+        elapsed = time.time() - start_time
+        lines = lines_done.value
+        log.debug(f"{phase}: {lines} lines, {int(lines / elapsed)} lines/sec")
+        metrics.emit(phase, "progress", lines=lines, lines_per_sec=int(lines / elapsed))
+        report_time = time.time()
+
+    def put(task):
+        while True:
+            try:
+                tasks.put(task, timeout=1)
+                return
+            except queue.Full:
+                check_workers(processes)
+                report()
+
+    worker_results = []
+    try:
+        with metrics.phase(phase) as m:
+            for task in dump_tasks(triplefile_paths, chunk_size):
+                m["bytes_read"] += len(task) if isinstance(task, bytes) else task[2] - task[1]
+                put(task)
+                report()
+            for _ in processes:
+                put(None)
+            while len(worker_results) < len(processes):
+                try:
+                    worker_results.append(results.get(timeout=1))
+                except queue.Empty:
+                    check_workers(processes)
+                    report()
+            m["rows"] = sum(x["lines"] for x in worker_results)
+    finally:
+        for worker in processes:
+            if worker.is_alive() and len(worker_results) < len(processes):
+                worker.terminate()
+            worker.join()
+    return worker_results
+
+
+def as_list(triplefile_paths):
+    if not type(triplefile_paths) == list:
+        return [triplefile_paths]
+    return triplefile_paths
+
+
+def dump_summary(worker_results: list, start_time: float):
+    duration = time.time() - start_time
+    lines = sum(x["lines"] for x in worker_results)
+    return {
+        "duration": int(duration),
+        "lines": lines,
+        "lines_per_sec": int(lines / duration) if duration > 0 else 0,
+        "count": sum(x["triples"] + x["quads"] for x in worker_results),
+        "malformed": sum(x["malformed"] for x in worker_results),
+    }
+
+
+def index_dump(
+    triplefile_paths: list,
+    out_path: str = "raw",
+    workers: int = 4,
+    prefix: str | None = None,
+    row_group_size: int = BIKIDATA_ROW_GROUP_SIZE,
+    chunk_size: int = READ_SIZE,
+    batch_size: int = BIKIDATA_STAGING_BATCH,
+    progress_callback=None,
+):
+    """
+    Hash the triples in triplefile_paths, like a (split) Wikidata dump, to Parquet files of
+    (s, p, o, g) xxhash ubigints in out_path, that can be queried with BIKIDATA_PARQUET_PATH
+    together with the term map of map_dump(). Each of the workers processes chunks of
+    chunk_size bytes and writes its own files, named <prefix>-<worker>-<seq>.parquet.
+    The prefix defaults to the name of a single input file, xaa for xaa.bz2, or "part".
+    The aggregate lines/sec is logged, and passed to progress_callback, as it goes.
+    """
+    start_time = time.time()
+    triplefile_paths = as_list(triplefile_paths)
+    if prefix is None:
+        prefix = "part"
+        if len(triplefile_paths) == 1:
+            prefix = os.path.basename(strip_compression_suffix(triplefile_paths[0]))
+            prefix = os.path.splitext(prefix)[0] if prefix.endswith(".nt") else prefix
+    os.makedirs(out_path, exist_ok=True)
+    metrics = BuildMetrics(progress_callback)
+    worker_results = run_dump(
+        "index",
+        index_worker,
+        (out_path, prefix, row_group_size, batch_size),
+        triplefile_paths,
+        workers,
+        chunk_size,
+        metrics,
+    )
+    result = dump_summary(worker_results, start_time)
+    result["files"] = sorted(f for x in worker_results for f in x["files"])
+    result.update(metrics.report())
+    return result
+
+
+def map_dump(
+    triplefile_paths: list,
+    out_path: str = "raw",
+    workers: int = 4,
+    shards: int = BIKIDATA_MAP_SHARDS,
+    row_group_size: int = BIKIDATA_ROW_GROUP_SIZE,
+    chunk_size: int = READ_SIZE,
+    batch_size: int = BIKIDATA_STAGING_BATCH,
+    dedup_memory: int = BIKIDATA_DEDUP_MEMORY,
+    progress_callback=None,
+):
+    """
+    Build the map from hash to IRI or literal for all the terms in triplefile_paths, in
+    out_path/terms/part-<shard>.parquet files with (hash, value) columns, sorted by hash.
+    The workers go over all the input in parallel, like index_dump(), and spill their terms
+    split into shards by hash range. Each shard is then de-duplicated exactly by a group by
+    in its own process, and only holds 1/shards of the terms. Existing part files are replaced.
+    """
+    start_time = time.time()
+    triplefile_paths = as_list(triplefile_paths)
+    terms_path = os.path.join(out_path, "terms")
+    spill_path = os.path.join(out_path, "terms.tmp")
+    shutil.rmtree(spill_path, ignore_errors=True)
+    os.makedirs(terms_path, exist_ok=True)
+    for old_file in glob.glob(os.path.join(terms_path, "part-*.parquet")):
+        os.unlink(old_file)
+    metrics = BuildMetrics(progress_callback, [spill_path])
+
+    worker_results = run_dump(
+        "map",
+        map_worker,
+        (spill_path, shards, batch_size, dedup_memory),
+        triplefile_paths,
+        workers,
+        chunk_size,
+        metrics,
+    )
+    tasks = [
+        (
+            shard,
+            spill_path,
+            os.path.join(terms_path, f"part-{shard:05d}.parquet"),
+            row_group_size,
+        )
+        for shard in range(shards)
+    ]
+    with metrics.phase("merge") as m:
+        with mp.Pool(workers) as pool:
+            for count in pool.imap_unordered(merge_shard, tasks):
+                m["rows"] += count
+                metrics.emit("merge", "progress", terms=m["rows"])
+    shutil.rmtree(spill_path, ignore_errors=True)
+
+    result = dump_summary(worker_results, start_time)
+    result["terms"] = metrics.get("merge")["rows"]
+    result["files"] = [task[2] for task in tasks]
+    result.update(metrics.report())
+    return result
@@ -0,0 +1,88 @@
+import os, io, shutil, tempfile, time
+from .main import log
+from .pool import POOL
+from .query import results_triples_sql, triple_tables, dense_ids, execute
+
+# Exports to a filename are written in this directory, and can not be written outside of it
+BIKIDATA_EXPORT_PATH = os.getenv("BIKIDATA_EXPORT_PATH", "exports")
+
+# The lines are written as they are, one column without quoting
+TEXT_OPTIONS = "format csv, header false, quote '', escape ''"
+
+
+def export_path(filename: str):
+    """
+    The path of filename in BIKIDATA_EXPORT_PATH. Names that resolve outside of it, with
+    .. or an absolute path or through a symlink, and files that exist already, are refused.
+    """
+    base = os.path.realpath(BIKIDATA_EXPORT_PATH)
+    path = os.path.realpath(os.path.join(base, filename))
+    if path == base or os.path.commonpath([base, path]) != base:
+        raise ValueError(f"Can only export to a file in {base}, not {filename}")
+    if os.path.exists(path):
+        raise FileExistsError(f"{path} exists already")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def export_select(rows: str, file_format: str):
+    "The select that COPY writes for the triples of the results, see results_triples_sql()"
+    if file_format == "nt":
+        # Literals added with insert can hold line breaks, which N-Triples escapes
+        return f"""select s || ' ' || p || ' ' || replace(replace(o, chr(13), '\\r'), chr(10), '\\n') || ' .'
+            from ({rows}) order by pos""", TEXT_OPTIONS
+    if file_format == "ndjson":
+        # One line per entity, like the results of query()
+        return f"""select json_merge_patch(json_group_object(p, os), json_object('id', s, 'graph', json('[]')))
+            from (select pos, s, p, list(o) as os from ({rows}) group by pos, s, p)
+            group by pos, s order by pos""", TEXT_OPTIONS
+    if file_format == "parquet":
+        return (
+            f"select s, p, o from ({rows}) order by pos",
+            "format parquet, compression zstd",
+        )
+    raise ValueError(f"Unsupported export format {file_format}, use nt, ndjson or parquet")
+
+
+def export_query(opts: dict, destination, file_format: str = "nt"):
+    """
+    Write all the results of the query in opts with DuckDB's COPY, as N-Triples ("nt"),
+    one JSON entity per line ("ndjson") or a Parquet file of s, p, o ("parquet").
+    destination is a writable file object, or a filename in BIKIDATA_EXPORT_PATH, see
+    export_path(). A file object gets the export after it is written to a temp file.
+    The results are in the order of query(), its size, start and cursor are not used.
+    """
+    start_time = time.time()
+    if not hasattr(destination, "write"):
+        destination = export_path(destination)
+    with POOL.cursor() as db_cursor:
+        params = {}
+        rows = results_triples_sql(opts, triple_tables(db_cursor), params)
+        if rows is None:
+            raise ValueError("Nothing to export, the query has no filters")
+        select, options = export_select(rows, file_format)
+        dense = dense_ids(db_cursor)
+        with tempfile.TemporaryDirectory() as temp_path:
+            if isinstance(destination, str):
+                path = destination
+            else:
+                path = os.path.join(temp_path, f"export.{file_format}")
+            log.debug(f"Exporting the results as {file_format} to {path}")
+            quoted_path = path.replace("'", "''")
+            count = execute(
+                db_cursor, f"copy ({select}) to '{quoted_path}' ({options})", params, dense
+            ).fetchone()[0]
+            if not isinstance(destination, str):
+                with open(path, "rb") as exported:
+                    if isinstance(destination, io.TextIOBase):
+                        shutil.copyfileobj(
+                            io.TextIOWrapper(exported, encoding="utf-8"), destination
+                        )
+                    else:
+                        shutil.copyfileobj(exported, destination)
+    end_time = time.time()
+    return {
+        "duration": int(end_time - start_time),
+        "rows": count,
+        "path": destination if isinstance(destination, str) else None,
+    }
@@ -0,0 +1,290 @@
+import os, shutil, threading, time
+import numpy as np
+from .main import DB_PATH, log, temp_paths
+from .metrics import BuildMetrics
+
+# The IVF index of the vectors in literals_semantic, a directory of .npy files next to the database
+BIKIDATA_SEMANTIC_INDEX = os.getenv("BIKIDATA_SEMANTIC_INDEX", DB_PATH + ".ivf")
+# A semantic filter returns at most the K nearest entities, from the NPROBE lists nearest
+# to the query. More lists find more of the true nearest entities, and take longer.
+BIKIDATA_SEMANTIC_K = int(os.getenv("BIKIDATA_SEMANTIC_K", 1000))
+BIKIDATA_SEMANTIC_NPROBE = int(os.getenv("BIKIDATA_SEMANTIC_NPROBE", 8))
+# With BIKIDATA_SEMANTIC_QUANTIZE=int8 (1 byte per dimension) or binary (1 bit), the index
+# also stores the vectors as codes, next to the full vectors, so it takes more disk space.
+# A search then compares the codes, and only the k * RESCORE nearest by their codes
+# again with their full vectors.
+BIKIDATA_SEMANTIC_QUANTIZE = os.getenv("BIKIDATA_SEMANTIC_QUANTIZE", "")
+BIKIDATA_SEMANTIC_RESCORE = int(os.getenv("BIKIDATA_SEMANTIC_RESCORE", 4))
+
+# Vectors are read from literals_semantic, and compared to the centroids, this many at a time
+BATCH_SIZE = 8192
+# The centroids are trained on a sample of this many vectors per list
+TRAIN_PER_LIST = 64
+
+
+def normalized(vectors: np.ndarray):
+    "The vectors scaled to length 1, so that their dot product is the cosine similarity"
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def nearest_lists(vectors: np.ndarray, centroids: np.ndarray):
+    "The index of the nearest centroid of each of the vectors"
+    return np.concatenate(
+        [
+            np.argmax(vectors[idx : idx + BATCH_SIZE] @ centroids.T, axis=1)
+            for idx in range(0, len(vectors), BATCH_SIZE)
+        ]
+        or [np.empty(0, dtype=np.int64)]
+    )
+
+
+def train_centroids(sample: np.ndarray, lists: int, iterations: int, rng):
+    """
+    Spherical k-means: lists centroids of length 1 for the normalized vectors in sample.
+    A list that ends up without vectors gets a random vector of the sample as centroid.
+    """
+    centroids = sample[rng.choice(len(sample), lists, replace=False)]
+    for _ in range(iterations):
+        assignment = nearest_lists(sample, centroids)
+        order = np.argsort(assignment, kind="stable")
+        used, starts = np.unique(assignment[order], return_index=True)
+        sums = sample[rng.choice(len(sample), lists)]
+        sums[used] = np.add.reduceat(sample[order], starts)
+        centroids = normalized(sums)
+    return centroids
+
+
+def quantized(vectors: np.ndarray, scales: np.ndarray | None):
+    """
+    The codes of the normalized vectors: with scales, one int8 per dimension, the value
+    divided by the scale of the dimension, otherwise their signs packed in bits
+    """
+    if scales is not None:
+        return np.clip(np.rint(vectors / scales), -127, 127).astype(np.int8)
+    return np.packbits(vectors > 0, axis=-1)
+
+
+def vector_batches(db_cursor):
+    """
+    The vectors of literals_semantic, as (hashes, normalized vectors), BATCH_SIZE rows at
+    a time in the order of their rowid, so that each pass over them reads the same rows.
+    """
+    last = db_cursor.execute("select max(rowid) from literals_semantic").fetchone()[0]
+    for low in range(0, (last if last is not None else -1) + 1, BATCH_SIZE):
+        rows = db_cursor.execute(
+            """select hash, vec from literals_semantic
+            where rowid >= $low and rowid < $high and vec is not null order by rowid""",
+            {"low": low, "high": low + BATCH_SIZE},
+        ).fetchnumpy()
+        if len(rows["hash"]) > 0:
+            yield rows["hash"], normalized(np.stack(rows["vec"]).astype(np.float32))
+
+
+def index_semantic(
+    db_cursor,
+    metrics,
+    lists: int | None = None,
+    iterations: int = 10,
+    quantize: str = BIKIDATA_SEMANTIC_QUANTIZE,
+):
+    """
+    Build the IVF index of literals_semantic in BIKIDATA_SEMANTIC_INDEX: the centroids of
+    lists clusters of the vectors, by default the square root of their number, and the
+    vectors with their hashes grouped by their nearest centroid, with the offsets of each
+    group. A search then only compares the query to the vectors of a few groups.
+    With quantize "int8" or "binary" the codes of the vectors are stored too, see quantized(),
+    the int8 scale of each dimension is set by the largest value of the sample in it.
+    The full vectors are kept for rescoring, so the codes add a quarter (int8) or a
+    thirty-second (binary) to the size of the index.
+    The vectors are read twice, to assign them and to write them in place, and are not
+    all held in memory. The new index replaces the old one when it is complete.
+    """
+    count = db_cursor.execute(
+        "select count(*) from literals_semantic where vec is not null"
+    ).fetchone()[0]
+    if count == 0:
+        log.error("There are no vectors in literals_semantic to index")
+        return 0
+    if quantize not in ("", "int8", "binary"):
+        raise ValueError(f"Unsupported quantization {quantize}, use int8 or binary")
+    lists = min(lists or max(1, int(np.sqrt(count))), count)
+    rng = np.random.default_rng(42)
+
+    with metrics.phase("semantic_index") as index_metrics:
+        sample = db_cursor.execute(
+            f"""select vec from literals_semantic where vec is not null
+            using sample reservoir({lists * TRAIN_PER_LIST} rows) repeatable (42)"""
+        ).fetchnumpy()["vec"]
+        sample = normalized(np.stack(sample).astype(np.float32))
+        log.debug(f"Training {lists} centroids on {len(sample)} of {count} vectors")
+        centroids = train_centroids(sample, lists, iterations, rng)
+
+        hashes, assignment = [], []
+        for batch_hashes, vectors in vector_batches(db_cursor):
+            hashes.append(batch_hashes)
+            assignment.append(nearest_lists(vectors, centroids))
+            metrics.emit("semantic_index", "progress", done=sum(map(len, hashes)), total=count)
+        hashes, assignment = np.concatenate(hashes), np.concatenate(assignment)
+        order = np.argsort(assignment, kind="stable")
+        positions = np.empty(len(order), dtype=np.int64)
+        positions[order] = np.arange(len(order))
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=lists))])
+
+        new_path = BIKIDATA_SEMANTIC_INDEX + ".new"
+        shutil.rmtree(new_path, ignore_errors=True)
+        os.makedirs(new_path)
+        np.save(os.path.join(new_path, "centroids.npy"), centroids)
+        np.save(os.path.join(new_path, "offsets.npy"), offsets)
+        np.save(os.path.join(new_path, "hashes.npy"), hashes[order])
+        dimensions = centroids.shape[1]
+        files = {"vectors.npy": (np.float32, dimensions)}
+        scales = None
+        if quantize == "int8":
+            scales = np.abs(sample).max(axis=0) / 127
+            scales[scales == 0] = 1
+            np.save(os.path.join(new_path, "scales.npy"), scales)
+            files["codes.npy"] = (np.int8, dimensions)
+        elif quantize == "binary":
+            files["bits.npy"] = (np.uint8, (dimensions + 7) // 8)
+        stored = {
+            filename: np.lib.format.open_memmap(
+                os.path.join(new_path, filename),
+                mode="w+",
+                dtype=dtype,
+                shape=(len(order), width),
+            )
+            for filename, (dtype, width) in files.items()
+        }
+        done = 0
+        for _, vectors in vector_batches(db_cursor):
+            rows = positions[done : done + len(vectors)]
+            stored["vectors.npy"][rows] = vectors
+            if quantize:
+                stored["codes.npy" if scales is not None else "bits.npy"][rows] = quantized(
+                    vectors, scales
+                )
+            done += len(vectors)
+        for array in stored.values():
+            array.flush()
+        del stored
+
+        old_path = BIKIDATA_SEMANTIC_INDEX + ".old"
+        if os.path.exists(BIKIDATA_SEMANTIC_INDEX):
+            os.replace(BIKIDATA_SEMANTIC_INDEX, old_path)
+        os.replace(new_path, BIKIDATA_SEMANTIC_INDEX)
+        shutil.rmtree(old_path, ignore_errors=True)
+        index_metrics["rows"] += len(order)
+    return len(order)
+
+
+def build_semantic_index(
+    lists: int | None = None,
+    iterations: int = 10,
+    quantize: str = BIKIDATA_SEMANTIC_QUANTIZE,
+    progress_callback=None,
+) -> dict:
+    """
+    (Re)build the IVF index of the vectors that build_semantic() stored, see index_semantic().
+    build_semantic() does this when it is done, call it after changing literals_semantic otherwise.
+    A quantize of "int8" or "binary" makes searches faster, and the index larger: the codes
+    are stored next to the full vectors, which also stay in literals_semantic.
+    """
+    from .pool import POOL
+
+    start_time = time.time()
+    metrics = BuildMetrics(progress_callback, temp_paths())
+    with POOL.cursor() as db_cursor:
+        count = index_semantic(db_cursor, metrics, lists, iterations, quantize)
+    end_time = time.time()
+    result = {"duration": int(end_time - start_time), "count": count}
+    result.update(metrics.report())
+    return result
+
+
+class SemanticIndex:
+    """
+    The IVF index in path, see index_semantic(), with the vectors, their codes and their
+    hashes memory-mapped
+    """
+
+    def __init__(self, path: str):
+        self.centroids = np.load(os.path.join(path, "centroids.npy"))
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.hashes = np.load(os.path.join(path, "hashes.npy"), mmap_mode="r")
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.codes, self.scales = None, None
+        if os.path.exists(os.path.join(path, "codes.npy")):
+            self.codes = np.load(os.path.join(path, "codes.npy"), mmap_mode="r")
+            self.scales = np.load(os.path.join(path, "scales.npy"))
+        elif os.path.exists(os.path.join(path, "bits.npy")):
+            self.codes = np.load(os.path.join(path, "bits.npy"), mmap_mode="r")
+
+    def coarse_scores(self, query: np.ndarray, start: int, end: int):
+        """
+        How near the codes of the vectors from start to end are to the query, higher is
+        nearer: the dot product with the int8 codes, or minus the Hamming distance of the bits
+        """
+        if self.scales is not None:
+            return self.codes[start:end].astype(np.float32) @ (query * self.scales)
+        bits = quantized(query, None)
+        return -np.bitwise_count(self.codes[start:end] ^ bits).sum(axis=1, dtype=np.int32)
+
+    def search(
+        self,
+        vector: list,
+        k: int,
+        nprobe: int,
+        max_distance: float,
+        rescore: int = BIKIDATA_SEMANTIC_RESCORE,
+    ):
+        """
+        The hashes and the cosine distances of the at most k vectors nearest to vector, that
+        are closer than max_distance, nearest first. Only the vectors in the nprobe lists
+        with the nearest centroids are compared, so a few of the nearest can be missed.
+        With codes, only the k * rescore vectors with the nearest codes are compared, a
+        larger rescore misses fewer of them.
+        """
+        query = normalized(np.asarray(vector, dtype=np.float32))
+        nprobe = min(nprobe, len(self.centroids))
+        probed = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        lists = [(self.offsets[idx], self.offsets[idx + 1]) for idx in probed]
+        rows = np.concatenate([np.arange(start, end) for start, end in lists])
+        candidates = k * rescore
+        if self.codes is not None and len(rows) > candidates:
+            coarse = np.concatenate([self.coarse_scores(query, *bounds) for bounds in lists])
+            rows = np.sort(rows[np.argpartition(-coarse, candidates - 1)[:candidates]])
+            distances = 1 - self.vectors[rows] @ query
+        else:
+            distances = np.concatenate(
+                [1 - self.vectors[start:end] @ query for start, end in lists]
+            )
+        near = np.flatnonzero(distances < max_distance)
+        rows, distances = rows[near], distances[near]
+        if len(distances) > k:
+            best = np.argpartition(distances, k - 1)[:k]
+            rows, distances = rows[best], distances[best]
+        order = np.argsort(distances, kind="stable")
+        return self.hashes[rows[order]], distances[order]
+
+
+INDEX_LOCK = threading.Lock()
+LOADED = {"signature": None, "index": None}
+
+
+def semantic_index():
+    """
+    The SemanticIndex in BIKIDATA_SEMANTIC_INDEX, or None when there is none.
+    It is loaded once per process, and again when a new index replaced it.
+    """
+    try:
+        stat = os.stat(os.path.join(BIKIDATA_SEMANTIC_INDEX, "offsets.npy"))
+    except FileNotFoundError:
+        return None
+    signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    with INDEX_LOCK:
+        if LOADED["signature"] != signature:
+            log.debug(f"Loading the semantic index in {BIKIDATA_SEMANTIC_INDEX}")
+            LOADED["index"] = SemanticIndex(BIKIDATA_SEMANTIC_INDEX)
+            LOADED["signature"] = signature
+        return LOADED["index"]
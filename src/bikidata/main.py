@@ -1,6 +1,26 @@
-import sys, logging, gzip, re, os, time
+import sys, logging, os, re, time
+import multiprocessing as mp
 import duckdb
-import xxhash
+from .staging import (
+    H,
+    StagingWriter,
+    clear_staging,
+    input_fingerprint,
+    load_checkpoint,
+    read_json,
+    save_checkpoint,
+    stage_triples,
+    stage_triples_timed,
+    write_json,
+)
+from .metrics import BuildMetrics
+from .decompress import COMPRESSED_SUFFIXES, open_input, strip_compression_suffix
+from .ntriples import (
+    decode_unicode_escapes,
+    iter_line_batches,
+    new_stats,
+    tokenize_lines,
+)
 
 DEBUG = os.environ.get("DEBUG", "1") == "1"
 
@@ -17,6 +37,10 @@ handler.setFormatter(formatter)
 
 DB_PATH = os.getenv("BIKIDATA_DB", "bikidata.duckdb")
 log.debug(f"BIKIDATA_DB is configured as {DB_PATH}")
+# Directory where the hashed triples and terms are staged as Parquet files during a build
+BIKIDATA_STAGING_PATH = os.getenv("BIKIDATA_STAGING_PATH", DB_PATH + ".staging")
+# When set, queries run over the Parquet files in this directory instead of DB_PATH
+BIKIDATA_PARQUET_PATH = os.getenv("BIKIDATA_PARQUET_PATH")
 
 
 def literal_to_parts(literal: str):
@@ -36,173 +60,518 @@ def literal_to_parts(literal: str):
     return literal_value, language, datatype
 
 
-def decode_unicode_escapes(s):
-    # See: https://www.w3.org/TR/n-triples/#grammar-production-UCHAR
-    unicode_escape_pattern_u = re.compile(
-        r"\\u([0-9a-fA-F]{4})"
-    )  # \uXXXX (4 hex digits)
-    unicode_escape_pattern_U = re.compile(
-        r"\\U([0-9a-fA-F]{8})"
-    )  # \UXXXXXXXX (8 hex digits)
-
-    def replace_unicode_escape_u(match):
-        hex_value = match.group(1)
-        return chr(
-            int(hex_value, 16)
-        )  # Convert hex to integer, then to Unicode character
-
-    def replace_unicode_escape_U(match):
-        hex_value = match.group(1)
-        return chr(
-            int(hex_value, 16)
-        )  # Convert hex to integer, then to Unicode character
-
-    s = unicode_escape_pattern_U.sub(replace_unicode_escape_U, s)
-    s = unicode_escape_pattern_u.sub(replace_unicode_escape_u, s)
-
-    return s
-
-
 class StringParamException(Exception):
     pass
 
 
-def read_nt(triplefile_paths: list):
+def open_triplefile(triplefile_path):
+    if isinstance(triplefile_path, (str, bytes, os.PathLike)):
+        return open_input(triplefile_path)
+    elif hasattr(triplefile_path, "read"):
+        return triplefile_path
+    raise StringParamException(
+        "Each path in triplefile_paths must be a string, bytes, os.PathLike object, or a file-like object"
+    )
+
+
+def read_nt(triplefile_paths: list, stats: dict | None = None):
     if not type(triplefile_paths) == list:
         raise StringParamException(
             "triplefile_paths must be a list of paths to n-triple files, or file-like objects"
         )
+    if stats is None:
+        stats = new_stats()
     for triplefile_path in triplefile_paths:
-        if isinstance(triplefile_path, (str, bytes, os.PathLike)):
-            if triplefile_path.endswith(".gz"):
-                thefile = gzip.open(triplefile_path, "rb")
-            else:
-                thefile = open(triplefile_path, "rb")
-        elif hasattr(triplefile_path, "read"):
-            thefile = triplefile_path
-        else:
-            raise StringParamException(
-                "Each path in triplefile_paths must be a string, bytes, os.PathLike object, or a file-like object"
+        thefile = open_triplefile(triplefile_path)
+        malformed = stats["malformed"]
+        yield from tokenize_lines(iter_line_batches(thefile), stats)
+        if stats["malformed"] > malformed:
+            log.warning(
+                f"Skipped {stats['malformed'] - malformed} malformed lines in {triplefile_path}"
             )
 
-        g = ""
-        for line in thefile:
-            if not line.endswith(b" .\n"):
-                if line.endswith(b" {\n") and line.startswith(b"<"):
-                    # Cater for .trig files by looking for a pattern like
-                    # ^<IRI> {\n
-                    parts = line.decode("utf8").split(" ")
-                    if len(parts) == 2:
-                        g = parts[0]
-                        continue
-                else:
-                    continue
-            line = decode_unicode_escapes(line.decode("utf8"))
-            line = line.strip()
-            line = line[:-2]
-            parts = line.split(" ")
-            if len(parts) > 2:
-                s = parts[0]
-                p = parts[1]
-                o = " ".join(parts[2:])
-
-            if not (s.startswith("<") and s.endswith(">")):
-                if not s.startswith("_:"):
-                    continue
-            if not (p.startswith("<") and p.endswith(">")):
-                continue
 
-            yield s, p, o, g
+def align_offset(thefile, offset: int):
+    "Return the offset of the first line starting at, or after, offset"
+    if offset == 0:
+        return 0
+    thefile.seek(offset - 1)
+    return offset - 1 + len(thefile.readline())
+
+
+BUILD_MODES = ("create", "append")
+# The phases of a build that happen in the (parallel) staging of the input
+STAGING_PHASES = ("parse", "hash", "stage")
+
+
+def temp_paths(settings: dict | None = None):
+    "Where a build puts temporary data: the staging directory, and the DuckDB spill directory"
+    settings = settings or build_settings()
+    return [BIKIDATA_STAGING_PATH, settings["temp_directory"]]
+
+
+def build_settings(
+    memory_limit: str | None = None,
+    threads: int | None = None,
+    temp_directory: str | None = None,
+    partitions: int | None = None,
+    dense_ids: bool | None = None,
+):
+    """
+    The resource budget for the DuckDB-heavy phases of a build, arguments override the
+    BIKIDATA_MEMORY_LIMIT, BIKIDATA_THREADS, BIKIDATA_TEMP_DIRECTORY and BIKIDATA_PARTITIONS
+    environment variables. memory_limit is in DuckDB syntax, like '12GB', None leaves
+    the DuckDB defaults. With partitions > 1 the large group by and string_agg statements
+    are run on that many slices of the hash space, one after the other.
+    dense_ids (or BIKIDATA_DENSE_IDS=1) stores terms by dense ids instead of hashes, see load_staging().
+    """
+    settings = {
+        "memory_limit": memory_limit or os.environ.get("BIKIDATA_MEMORY_LIMIT"),
+        "threads": int(threads or os.environ.get("BIKIDATA_THREADS", 0)) or None,
+        "temp_directory": temp_directory
+        or os.environ.get("BIKIDATA_TEMP_DIRECTORY", DB_PATH + ".tmp"),
+        "partitions": max(1, int(partitions or os.environ.get("BIKIDATA_PARTITIONS", 1))),
+        "dense_ids": (
+            dense_ids
+            if dense_ids is not None
+            else os.environ.get("BIKIDATA_DENSE_IDS", "0") == "1"
+        ),
+    }
+    log.debug(f"Build settings: {settings}")
+    return settings
+
 
+def release_query_pool():
+    "DB_PATH can not be opened for writing while the query pool of this process has it open read-only"
+    from .pool import POOL
 
-def H(v: str):
-    return xxhash.xxh64_hexdigest(v).upper()
+    POOL.close()
+
+
+def connect_for_build(settings: dict):
+    "Open DB_PATH with the memory, thread and spill settings of the build applied"
+    release_query_pool()
+    DB = duckdb.connect(DB_PATH)
+    if settings["memory_limit"]:
+        DB.execute(f"SET memory_limit = '{settings['memory_limit']}'")
+    if settings["threads"]:
+        DB.execute(f"SET threads = {int(settings['threads'])}")
+    DB.execute(f"SET temp_directory = '{settings['temp_directory']}'")
+    # Keeping the input order forces large inserts to buffer more than they need
+    DB.execute("SET preserve_insertion_order = false")
+    return DB
+
+
+# Copies of the triples table, clustered for lookups by predicate (and object) and by object.
+# triples itself is sorted by s, p, o. The min/max zone maps of each row group then let
+# DuckDB skip most of the table for a selective filter on the leading columns.
+PERMUTATIONS = {"triples_pos": "p, o, s", "triples_osp": "o, s, p"}
+
+
+def has_table(db_connection, table: str):
+    return (
+        db_connection.execute(
+            f"select count(*) from duckdb_tables() where schema_name = 'main' and table_name = '{table}' and not temporary"
+        ).fetchone()[0]
+        > 0
+    )
+
+
+def hash_slices(column: str, partitions: int, value_range: tuple = (0, 2**64)):
+    """
+    SQL conditions that split the ubigint values of column into contiguous slices of value_range.
+    Slices are in ascending order, so inserting them one by one keeps a table sorted.
+    """
+    if partitions <= 1:
+        return ["true"]
+    low, high = value_range
+    bounds = [low + i * (high - low) // partitions for i in range(1, partitions)]
+    slices = [f"{column} < {bounds[0]}"]
+    for start, end in zip(bounds, bounds[1:]):
+        slices.append(f"{column} >= {start} and {column} < {end}")
+    slices.append(f"{column} >= {bounds[-1]}")
+    return slices
+
+
+def key_range(db_connection, relation: str, column: str, dense: bool):
+    """
+    The range of the values of column in relation for hash_slices().
+    Hashes are spread over all of the ubigints, dense ids only over the ids handed out,
+    and those of one kind of term are close together, so take their min and max.
+    """
+    if not dense:
+        return (0, 2**64)
+    low, high = db_connection.execute(
+        f"select min({column}), max({column}) from {relation}"
+    ).fetchone()
+    if low is None:
+        return (0, 1)
+    return (low, high + 1)
+
+
+def check_slices(rows: list, what: str):
+    "Warn when slices are empty, then the partitions do not split the memory needed"
+    empty = rows.count(0)
+    if len(rows) > 1 and sum(rows) >= len(rows) and empty:
+        log.warning(f"{empty} of {len(rows)} slices of the {what} are empty")
 
 
 def build(
     triplefile_paths: list,
     stemmer: str = "porter",
+    workers: int = 1,
+    mode: str = "create",
+    resume: bool = False,
+    progress_callback=None,
+    memory_limit: str | None = None,
+    threads: int | None = None,
+    temp_directory: str | None = None,
+    partitions: int | None = None,
+    dense_ids: bool | None = None,
 ):
+    """
+    Index the triplefiles into the database at DB_PATH.
+    mode="create" only works on an empty database, mode="append" merges the triples
+    into an existing one, skipping the triples it already has.
+    Builds from file paths are checkpointed in BIKIDATA_STAGING_PATH, after a crash
+    the same build can be continued with resume=True.
+    The result includes metrics per phase of the build, progress_callback is called
+    with the metrics at the start, end and progress of each phase, see BuildMetrics.
+    memory_limit, threads, temp_directory and partitions set the resources DuckDB
+    may use for loading the data and building the indexes, see build_settings().
+    With dense_ids the terms are stored by sequential ids instead of their hashes.
+    """
+    settings = build_settings(
+        memory_limit, threads, temp_directory, partitions, dense_ids
+    )
     if len(triplefile_paths) > 0:
         log.debug(f"Building Bikidata index with {triplefile_paths}")
-        iterator = read_nt(triplefile_paths)
-        build_from_iterator(iterator, stemmer)
+        if all(isinstance(x, (str, os.PathLike)) for x in triplefile_paths):
+            return build_files(
+                triplefile_paths,
+                stemmer,
+                workers,
+                mode,
+                resume,
+                progress_callback,
+                settings,
+            )
+        if workers > 1 or resume:
+            raise StringParamException(
+                "Parallel and resumable builds need paths to n-triple files, not file-like objects"
+            )
+        stats = new_stats()
+        iterator = read_nt(triplefile_paths, stats)
+        result = build_from_iterator(
+            iterator, stemmer, mode, progress_callback, settings
+        )
+        result["malformed"] = stats["malformed"]
+        return result
     else:
         error = "No triples to index, triplefile_paths length < 1"
         log.error(error)
         return {"duration": 0, "error": error}
 
 
-def build_from_iterator(iterator, stemmer: str = "porter"):
-
-    start_time = time.time()
-
+def check_empty_db(mode: str = "create"):
+    if mode not in BUILD_MODES:
+        raise ValueError(f"Unknown build mode '{mode}', use one of {BUILD_MODES}")
+    if mode == "append":
+        return
+    release_query_pool()
     DB = duckdb.connect(DB_PATH)
-    db_connection = DB.cursor()
     try:
-        triple_count = db_connection.execute("select count(*) from triples").fetchall()
+        triple_count = DB.execute("select count(*) from triples").fetchall()
         if triple_count[0][0] > 0:
             error = f"The database [{DB_PATH}] already has data, doing nothing"
             log.debug(error)
-            return {"duration": 0, "error": error}
-
+            return error
     except duckdb.CatalogException:
         log.debug("Good, there are no triples in bikidate table yet")
+    finally:
+        DB.close()
 
-    TRIPLE_PATH = os.getenv("BIKIDATA_TRIPLE_PATH", "triples")
-    MAP_PATH = os.getenv("BIKIDATA_MAP_PATH", "maps")
 
-    count = 0
+def build_from_iterator(
+    iterator,
+    stemmer: str = "porter",
+    mode: str = "create",
+    progress_callback=None,
+    settings: dict | None = None,
+):
+
+    start_time = time.time()
+
+    error = check_empty_db(mode)
+    if error:
+        return {"duration": 0, "error": error}
 
-    TRIPLE_OUT_FILE = open(TRIPLE_PATH, "w")
-    MAP_OUT_FILE = open(MAP_PATH, "w")
-
-    all_graphs = set()
-    for s, p, o, g in iterator:
-        try:
-            ss = H(s)
-            pp = H(p)
-            oo = H(o)
-            gg = H(g)
-            all_graphs.add(g)
-            TRIPLE_OUT_FILE.write(f"{ss}\t{pp}\t{oo}\t{gg}\n")
-            MAP_OUT_FILE.write(f"{ss}\t|\t{s}\n")
-            MAP_OUT_FILE.write(f"{pp}\t|\t{p}\n")
-            MAP_OUT_FILE.write(f"{oo}\t|\t{o}\n")
-            count += 1
-        except UnicodeEncodeError as e:
-            log.error(f"Error hashing {e}")
+    settings = settings or build_settings()
+    metrics = BuildMetrics(progress_callback, temp_paths(settings))
+    timings = {"parse": 0.0, "hash": 0.0}
+    writer = StagingWriter(BIKIDATA_STAGING_PATH)
+    for name in STAGING_PHASES:
+        metrics.emit(name, "start")
+    stage_triples_timed(iterator, writer, timings)
+    writer.close()
+    metrics.add("parse", timings["parse"], writer.count)
+    metrics.add("hash", timings["hash"], writer.count)
+    metrics.add("stage", writer.flush_seconds, writer.count)
+    for name in STAGING_PHASES:
+        metrics.emit(name, "end")
+
+    result = load_staging(
+        writer.triple_files,
+        writer.term_files,
+        stemmer,
+        mode,
+        metrics=metrics,
+        settings=settings,
+    )
+
+    clear_staging(BIKIDATA_STAGING_PATH)
+    end_time = time.time()
+    result.update({"duration": int(end_time - start_time), "count": writer.count})
+    result.update(metrics.report())
+    return result
+
+
+# Uncompressed files larger than this are split into byte ranges for parallel builds
+BIKIDATA_CHUNK_SIZE = int(os.getenv("BIKIDATA_CHUNK_SIZE", 256 * 1024 * 1024))
+
+
+def plan_partitions(triplefile_paths: list, workers: int):
+    """
+    Split the input into (path, start, end) tasks for the worker pool.
+    Compressed and .trig files can not be entered at an arbitrary offset, they become a single task.
+    Large plain files are cut into byte ranges, small enough to keep all the workers busy.
+    """
+    total_size = sum(os.path.getsize(x) for x in triplefile_paths)
+    chunk_size = max(
+        16 * 1024 * 1024, min(BIKIDATA_CHUNK_SIZE, total_size // (workers * 4) + 1)
+    )
+
+    tasks = []
+    for triplefile_path in triplefile_paths:
+        size = os.path.getsize(triplefile_path)
+        if (
+            workers < 2
+            or str(triplefile_path).endswith(COMPRESSED_SUFFIXES + (".trig",))
+            or size <= chunk_size
+        ):
+            tasks.append((str(triplefile_path), 0, None))
             continue
-            # Certain strings can casues errors, especially emojis encoded in JSON
-            # For example, "\ud83d\ude09" is how the smiley gets encoded in JSON (as a Javascript string)
-            # If you try to treat this as a UTF-8 string it throws an error.
-            # json.loads(r'"\ud83d\ude09"') <- this works
-            # "\ud83d\ude09".encode('utf8') <- this throws an error
-    for g in all_graphs:
-        gg = H(g)
-        MAP_OUT_FILE.write(f"{gg}\t|\t{g}\n")
-
-    TRIPLE_OUT_FILE.close()
-    MAP_OUT_FILE.close()
+        for start in range(0, size, chunk_size):
+            tasks.append((str(triplefile_path), start, min(start + chunk_size, size)))
+    return tasks
 
-    DB_SCHEMA = """
-    create table if not exists literals (hash ubigint, value varchar);
-    create table if not exists iris (hash ubigint, value varchar);
-    create table if not exists triples (s ubigint, p ubigint, o ubigint, g ubigint);    
+
+def stage_partition(task):
+    """
+    Worker entry point, hash one (idx, path, start, end) task into its own staging files.
+    Progress is saved in task-<idx>.json each time a batch is spilled, with the offset
+    in the (uncompressed) input up to which the spilled files are complete.
+    A task that was interrupted continues from there, a finished one is skipped.
     """
+    idx, triplefile_path, start, end = task
+    progress_path = os.path.join(BIKIDATA_STAGING_PATH, f"task-{idx:05d}.json")
+    progress = read_json(progress_path) or {
+        "offset": None,
+        "done": False,
+        "triple_files": [],
+        "term_files": [],
+        "count": 0,
+        "malformed": 0,
+        "bytes_read": 0,
+        "timings": {"parse": 0.0, "hash": 0.0, "stage": 0.0},
+    }
+    if progress["done"]:
+        return progress
+    # The graph of a .trig statement depends on earlier lines, so those restart from the top
+    can_resume = not strip_compression_suffix(triplefile_path).endswith(".trig")
 
-    db_connection.execute(DB_SCHEMA)
-    db_connection.execute(
-        rf"insert into triples(s,p,o,g) select ('0x' || column0).lower()::ubigint, ('0x' || column1).lower()::ubigint, ('0x' || column2).lower()::ubigint, ('0x' || column3).lower()::ubigint from read_csv('{TRIPLE_PATH}', delim='\t', header=false)"
+    stats = new_stats()
+    stats["malformed"] = progress["malformed"]
+    timings = dict(progress["timings"])
+    writer = StagingWriter(
+        BIKIDATA_STAGING_PATH,
+        prefix=f"{idx:05d}",
+        auto_flush=False,
+        triple_files=progress["triple_files"],
+        term_files=progress["term_files"],
+        count=progress["count"],
     )
-    db_connection.execute(
-        rf"""insert into literals select ('0x' || column0).lower()::ubigint, ANY_VALUE(column1) from read_csv('{MAP_PATH}', delim='\t|\t', header=false, max_line_size=5100000, quote='') where substr(column1, 1, 1) = '"' group by column0 order by column0 """
+    malformed_before = progress["malformed"]
+    bytes_before = progress["bytes_read"]
+    stage_before = timings["stage"]
+
+    def save_progress(offset: int, done: bool = False):
+        timings["stage"] = stage_before + writer.flush_seconds
+        progress.update(
+            {
+                "offset": offset,
+                "done": done,
+                "triple_files": writer.triple_files,
+                "term_files": writer.term_files,
+                "count": writer.count,
+                "malformed": stats["malformed"],
+                "bytes_read": bytes_before + offset - first_offset,
+                "timings": timings,
+            }
+        )
+        write_json(progress_path, progress)
+
+    with open_triplefile(triplefile_path) as thefile:
+        offset = progress["offset"]
+        if offset is None:
+            offset = align_offset(thefile, start)
+        first_offset = offset
+        limit = None if end is None else align_offset(thefile, end) - offset
+        # For compressed files this decompresses up to the offset
+        thefile.seek(offset)
+
+        # One block at a time, so that a batch is only spilled once all of its blocks are staged
+        state = {}
+        for block in iter_line_batches(thefile, limit=limit):
+            start_time = time.time()
+            triples = list(tokenize_lines((block,), stats, state))
+            parsed_time = time.time()
+            stage_triples(triples, writer)
+            timings["parse"] += parsed_time - start_time
+            timings["hash"] += time.time() - parsed_time
+            offset += len(block) + 1
+            if writer.full():
+                writer.flush()
+                if can_resume:
+                    save_progress(offset)
+        writer.close()
+
+    if stats["malformed"] > malformed_before:
+        log.warning(
+            f"Skipped {stats['malformed'] - malformed_before} malformed lines in {triplefile_path}"
+        )
+    save_progress(offset, done=True)
+    return progress
+
+
+def open_checkpoint(triplefile_paths: list, workers: int, mode: str, resume: bool):
+    """
+    Return the checkpoint to continue from, or start a new one.
+    The checkpoint holds the planned tasks, and the load phases that have been completed.
+    """
+    fingerprint = input_fingerprint(triplefile_paths)
+    checkpoint = load_checkpoint(BIKIDATA_STAGING_PATH)
+    if resume and checkpoint:
+        if checkpoint["inputs"] != fingerprint or checkpoint["mode"] != mode:
+            raise ValueError(
+                f"The checkpoint in {BIKIDATA_STAGING_PATH} is for a different build, remove it or build without resume=True"
+            )
+        log.debug(
+            f"Resuming build from {BIKIDATA_STAGING_PATH}, completed phases: {checkpoint['phases']}"
+        )
+        return checkpoint
+    if checkpoint:
+        log.debug(f"Discarding the previous checkpoint in {BIKIDATA_STAGING_PATH}")
+    clear_staging(BIKIDATA_STAGING_PATH)
+    checkpoint = {
+        "inputs": fingerprint,
+        "mode": mode,
+        "tasks": plan_partitions(triplefile_paths, workers),
+        "phases": [],
+        "result": {},
+    }
+    save_checkpoint(BIKIDATA_STAGING_PATH, checkpoint)
+    return checkpoint
+
+
+def phase_done(checkpoint: dict | None, phase: str):
+    return checkpoint is not None and phase in checkpoint["phases"]
+
+
+def mark_phase(checkpoint: dict | None, phase: str):
+    if checkpoint is not None:
+        checkpoint["phases"].append(phase)
+        save_checkpoint(BIKIDATA_STAGING_PATH, checkpoint)
+
+
+def run_tasks(func, tasks: list, workers: int):
+    "Yield the results of func over the tasks, in a process pool if there is more than one worker"
+    if workers > 1:
+        with mp.Pool(workers) as pool:
+            yield from pool.imap_unordered(func, tasks)
+    else:
+        yield from map(func, tasks)
+
+
+def build_files(
+    triplefile_paths: list,
+    stemmer: str = "porter",
+    workers: int = 1,
+    mode: str = "create",
+    resume: bool = False,
+    progress_callback=None,
+    settings: dict | None = None,
+):
+    start_time = time.time()
+
+    if mode not in BUILD_MODES:
+        raise ValueError(f"Unknown build mode '{mode}', use one of {BUILD_MODES}")
+    settings = settings or build_settings()
+    metrics = BuildMetrics(progress_callback, temp_paths(settings))
+    checkpoint = open_checkpoint(triplefile_paths, workers, mode, resume)
+    if not checkpoint["phases"]:
+        error = check_empty_db(mode)
+        if error:
+            clear_staging(BIKIDATA_STAGING_PATH)
+            return {"duration": 0, "error": error}
+
+    tasks = [
+        (idx, path, start, end)
+        for idx, (path, start, end) in enumerate(checkpoint["tasks"])
+    ]
+    log.debug(f"Staging {len(tasks)} partitions with {workers} workers")
+
+    count = 0
+    malformed = 0
+    done = 0
+    triple_files = []
+    term_files = []
+    # The parse, hash and stage times are summed over the workers
+    for name in STAGING_PHASES:
+        metrics.emit(name, "start")
+    for progress in run_tasks(stage_partition, tasks, workers):
+        triple_files.extend(progress["triple_files"])
+        term_files.extend(progress["term_files"])
+        count += progress["count"]
+        malformed += progress["malformed"]
+        metrics.add(
+            "parse",
+            progress["timings"]["parse"],
+            progress["count"],
+            progress["bytes_read"],
+        )
+        metrics.add("hash", progress["timings"]["hash"], progress["count"])
+        metrics.add("stage", progress["timings"]["stage"], progress["count"])
+        done += 1
+        log.debug(f"Staged {done}/{len(tasks)} partitions")
+        metrics.emit("stage", "progress", tasks_done=done, tasks=len(tasks))
+    for name in STAGING_PHASES:
+        metrics.emit(name, "end")
+
+    result = load_staging(
+        triple_files, term_files, stemmer, mode, checkpoint, metrics, settings
     )
 
-    db_connection.execute(
-        rf"""insert into iris select ('0x' || column0).lower()::ubigint, ANY_VALUE(column1) from read_csv('{MAP_PATH}', delim='\t|\t', header=false, max_line_size=5100000, quote='') where substr(column1, 1, 1) != '"'  group by column0 order by column0 """
+    clear_staging(BIKIDATA_STAGING_PATH)
+    end_time = time.time()
+    result.update(
+        {"duration": int(end_time - start_time), "count": count, "malformed": malformed}
     )
+    result.update(metrics.report())
+    return result
+
 
+def fts_settings(stemmer: str = "porter"):
     # We want to allow users to over-ride the FTS settings via environment variable config
     BIKIDATA_FTS_SETTINGS = os.environ.get("BIKIDATA_FTS_SETTINGS")
     if BIKIDATA_FTS_SETTINGS:
@@ -214,34 +583,388 @@ def build_from_iterator(iterator, stemmer: str = "porter"):
         log.info(
             f"No BIKIDATA_FTS_SETTINGS found, using default settings: {BIKIDATA_FTS_SETTINGS}"
         )
+    return BIKIDATA_FTS_SETTINGS
+
 
+def fts_stemmer(settings: str):
+    "The stemmer in the settings of create_fts_index, see fts_settings(), porter when not given"
+    if "stemmer" not in settings:
+        return "porter"
+    stemmer = re.search(r"stemmer\s*=\s*'(\w+)'", settings)
+    if stemmer is None:
+        raise ValueError(f"Can not read the stemmer in the fts settings {settings}")
+    return stemmer.group(1)
+
+
+def build_postings(db_connection, settings: str):
+    """
+    Create literals_postings(termid, docid, tf, len, hash) from the fts_main_literals index,
+    that was created with settings, sorted by termid, so that a search only reads the
+    postings of its terms, and the literals_query_terms(query_string) macro, the terms of a
+    search as they are indexed, with the tokenizer of the index and the stemmer of settings.
+    fts_main_literals.match_bm25() instead scores every literal, see query.fts_postings_sql().
+    """
+    stemmer = fts_stemmer(settings)
     db_connection.execute(
-        f"pragma create_fts_index('literals', 'hash', 'value', {BIKIDATA_FTS_SETTINGS})"
+        f"create or replace macro literals_query_terms(query_string) as list_distinct(list_transform(fts_main_literals.tokenize(query_string), t -> stem(t, '{stemmer}')))"
     )
-    db_connection.commit()
+    db_connection.execute(
+        """create or replace table literals_postings as
+        select T.termid, T.docid, count(*) as tf, any_value(D.len) as len, any_value(D.name) as hash
+        from fts_main_literals.terms T join fts_main_literals.docs D on D.docid = T.docid
+        group by T.termid, T.docid order by T.termid, T.docid"""
+    )
+    return db_connection.execute("select count(*) from literals_postings").fetchone()[0]
 
-    os.unlink(TRIPLE_PATH)
-    os.unlink(MAP_PATH)
-    end_time = time.time()
-    return {"duration": int(end_time - start_time), "count": count}
 
+# Set BIKIDATA_TRIGRAMS=0 to build without the trigram index of the literals
+BIKIDATA_TRIGRAMS = os.getenv("BIKIDATA_TRIGRAMS", "1") != "0"
+# A trigram of three ASCII characters a, b and c is numbered a * 128 * 128 + b * 128 + c
+TRIGRAM_CODES = 128**3
+TRIGRAM_MACROS = (
+    "create or replace macro ascii_codes(value) as list_transform(string_split(lower(value), ''), c -> unicode(c))",
+    """create or replace macro codes_trigrams(codes) as list_distinct(list_transform(
+        list_filter(list_zip(codes, codes[2:], codes[3:], true), t -> t[1] < 128 and t[2] < 128 and t[3] < 128),
+        t -> t[1] * 16384 + t[2] * 128 + t[3]))""",
+    "create or replace macro literal_trigrams(value) as codes_trigrams(ascii_codes(value))",
+)
 
-def build_ftss(stemmer: str = "porter"):
-    # For effective searches, the literals should be grouped by entity
-    start_time = time.time()
 
-    DB = duckdb.connect(DB_PATH)
+def build_trigrams(db_connection, partitions: int = 1):
+    """
+    Create literals_trigrams(trigram, hash), the trigrams of the lowercased literals that
+    are made of ASCII characters, sorted by trigram, and the literal_trigrams(value) macro
+    that lists them for a value. A regex or like filter then only checks the literals that
+    hold all the trigrams of its pattern, see query.pattern_trigrams().
+    With partitions > 1 the trigrams are sorted in that many slices, one after the other.
+    """
+    for macro in TRIGRAM_MACROS:
+        db_connection.execute(macro)
+    db_connection.execute(
+        "create or replace table literals_trigrams (trigram uinteger, hash ubigint)"
+    )
+    # The trigrams are listed once, the slices are sorted from that list
+    db_connection.execute(
+        """create or replace temp table literal_trigram_list as
+        select unnest(literal_trigrams(value)) as trigram, hash from literals"""
+    )
+    bounds = [0] + [i * TRIGRAM_CODES // partitions for i in range(1, partitions)]
+    for low, high in zip(bounds, bounds[1:] + [TRIGRAM_CODES]):
+        db_connection.execute(
+            f"""insert into literals_trigrams select trigram, hash from literal_trigram_list
+            where trigram >= {low} and trigram < {high} order by trigram, hash"""
+        )
+    db_connection.execute("drop table literal_trigram_list")
+    return db_connection.execute("select count(*) from literals_trigrams").fetchone()[0]
+
+
+def load_staging(
+    triple_files: list,
+    term_files: list,
+    stemmer: str = "porter",
+    mode: str = "create",
+    checkpoint: dict | None = None,
+    metrics: BuildMetrics | None = None,
+    settings: dict | None = None,
+):
+    """
+    Merge the staged triple and term files into the triples, iris and literals tables.
+    In append mode, only the triples and terms not yet in the database are added,
+    and the full-text indexes are refreshed if anything new was added.
+    Each phase is recorded in the checkpoint once it has been committed, a resumed
+    build skips the phases that are already done.
+    The triples are also copied into the PERMUTATIONS tables, clustered for other lookups.
+    The time taken is recorded in metrics, as the phases "triples", "dictionary",
+    "permutations", "fts" and "trigrams".
+
+    With settings["dense_ids"], or when appending to a database that has them, every term
+    gets a sequential id, in the order of the values so that IRIs in one namespace get
+    nearby ids. The terms(hash, id) table maps the xxhash of a term to its id, and the
+    triples, iris and literals tables hold the ids instead of the hashes. The ids are
+    smaller numbers that compress better and keep related terms together in joins.
+    """
+    if metrics is None:
+        metrics = BuildMetrics()
+    settings = settings or build_settings()
+    DB = connect_for_build(settings)
     db_connection = DB.cursor()
 
+    TRIPLE_FILES = ", ".join(f"'{path}'" for path in triple_files)
+    TERM_FILES = ", ".join(f"'{path}'" for path in term_files)
+    partitions = settings["partitions"]
+
+    DB_SCHEMA = """
+    create table if not exists literals (hash ubigint, value varchar);
+    create table if not exists iris (hash ubigint, value varchar);
+    create table if not exists triples (s ubigint, p ubigint, o ubigint, g ubigint);    
+    """
+
+    db_connection.execute(DB_SCHEMA)
+    result = checkpoint["result"] if checkpoint is not None else {}
+    # The ids are fixed once there is data, a resumed build finds its terms table
+    dense = has_table(db_connection, "terms")
+    if settings["dense_ids"] and not dense:
+        has_triples = db_connection.execute(
+            "select count(*) from (select 1 from triples limit 1)"
+        ).fetchone()[0]
+        if has_triples:
+            log.warning("Can not use dense ids in a database that stores hashes, keeping hashes")
+        else:
+            dense = True
+    if dense and TERM_FILES and not phase_done(checkpoint, "terms"):
+        with metrics.phase("dictionary") as dictionary_metrics:
+            db_connection.execute("begin transaction")
+            db_connection.execute(
+                "create table if not exists terms (hash ubigint, id ubigint)"
+            )
+            # Appended terms get ids after the existing ones
+            first_id = db_connection.execute(
+                "select coalesce(max(id), 0) + 1 from terms"
+            ).fetchone()[0]
+            # The default graph "" is not staged as a term, but needs an id for the triples in it
+            dictionary_metrics["rows"] += db_connection.execute(
+                f"""insert into terms select hash, {first_id} + row_number() over (order by value, hash) - 1 as id
+                from (
+                    select hash, ANY_VALUE(value) as value from read_parquet([{TERM_FILES}]) group by hash
+                    union select $default_graph::ubigint, ''
+                )
+                where hash not in (select hash from terms) order by hash""",
+                {"default_graph": H("")},
+            ).fetchone()[0]
+            db_connection.execute("commit")
+        mark_phase(checkpoint, "terms")
+
+    # The staged data with the ids it is stored by, sliced on those ids, see key_range()
+    if TRIPLE_FILES and dense:
+        db_connection.execute(
+            f"""create or replace temp view staged_triples as
+            select S.id as s, P.id as p, O.id as o, G.id as g from read_parquet([{TRIPLE_FILES}]) N
+            join terms S on N.s = S.hash join terms P on N.p = P.hash join terms O on N.o = O.hash join terms G on N.g = G.hash"""
+        )
+    elif TRIPLE_FILES:
+        db_connection.execute(
+            f"create or replace temp view staged_triples as select s, p, o, g from read_parquet([{TRIPLE_FILES}])"
+        )
+    if TERM_FILES and dense:
+        db_connection.execute(
+            f"""create or replace temp view staged_terms as
+            select N.hash, T.id, N.value from read_parquet([{TERM_FILES}]) N join terms T on N.hash = T.hash"""
+        )
+    elif TERM_FILES:
+        db_connection.execute(
+            f"create or replace temp view staged_terms as select hash, hash as id, value from read_parquet([{TERM_FILES}])"
+        )
+
+    if mode == "append":
+        if not phase_done(checkpoint, "loaded"):
+            # All or nothing, so that a crash can not leave half of the new triples behind
+            db_connection.execute("begin transaction")
+            db_connection.execute(
+                "create temp table new_triples (s ubigint, p ubigint, o ubigint, g ubigint)"
+            )
+            if TRIPLE_FILES:
+                s_range = key_range(db_connection, "staged_triples", "s", dense)
+                rows = [
+                    db_connection.execute(
+                        f"""insert into new_triples select distinct N.s, N.p, N.o, N.g from staged_triples N
+                        where {hash_slice} and not exists (select 1 from triples T where T.s = N.s and T.p = N.p and T.o = N.o and T.g = N.g)"""
+                    ).fetchone()[0]
+                    for hash_slice in hash_slices("N.s", partitions, s_range)
+                ]
+                check_slices(rows, "new triples")
+            with metrics.phase("triples") as triples_metrics:
+                db_connection.execute(
+                    "insert into triples(s,p,o,g) select s, p, o, g from new_triples order by s, p, o"
+                )
+                for table, order in PERMUTATIONS.items():
+                    if has_table(db_connection, table):
+                        db_connection.execute(
+                            f"insert into {table}(s,p,o,g) select s, p, o, g from new_triples order by {order}"
+                        )
+                result["triples_inserted"] = db_connection.execute(
+                    "select count(*) from new_triples"
+                ).fetchone()[0]
+                triples_metrics["rows"] += result["triples_inserted"]
+            for table, is_literal in (("literals", "="), ("iris", "!=")):
+                if not TERM_FILES:
+                    break
+                with metrics.phase("dictionary") as dictionary_metrics:
+                    id_range = key_range(
+                        db_connection,
+                        f"""staged_terms where substr(value, 1, 1) {is_literal} '"' and id not in (select hash from {table})""",
+                        "id",
+                        dense,
+                    )
+                    rows = [
+                        db_connection.execute(
+                            f"""insert into {table} select ANY_VALUE(N.id) as id, ANY_VALUE(N.value) from staged_terms N
+                            where {hash_slice} and substr(N.value, 1, 1) {is_literal} '"' and N.id not in (select hash from {table}) group by N.hash order by id """
+                        ).fetchone()[0]
+                        for hash_slice in hash_slices("N.id", partitions, id_range)
+                    ]
+                    check_slices(rows, table)
+                    inserted = sum(rows)
+                    result[f"{table}_inserted"] = inserted
+                    dictionary_metrics["rows"] += inserted
+
+            if has_table(db_connection, "fts") and result["triples_inserted"] > 0:
+                # Entities with new triples, and the entities that link to them, include their values.
+                # Not a temp table, a resumed build needs it to finish the fts phase.
+                db_connection.execute(
+                    """create or replace table fts_changed as
+                    select distinct s from new_triples
+                    union
+                    select distinct T.s from triples T join new_triples N on T.o = N.s"""
+                )
+            db_connection.execute("commit")
+            mark_phase(checkpoint, "loaded")
+    else:
+        if TRIPLE_FILES and not phase_done(checkpoint, "triples"):
+            # Sorted, in ascending slices of s, so that lookups by s can skip row groups
+            with metrics.phase("triples") as triples_metrics:
+                db_connection.execute("begin transaction")
+                s_range = key_range(db_connection, "staged_triples", "s", dense)
+                rows = [
+                    db_connection.execute(
+                        f"insert into triples(s,p,o,g) select s, p, o, g from staged_triples where {hash_slice} order by s, p, o"
+                    ).fetchone()[0]
+                    for hash_slice in hash_slices("s", partitions, s_range)
+                ]
+                check_slices(rows, "triples")
+                triples_metrics["rows"] += sum(rows)
+                db_connection.execute("commit")
+            mark_phase(checkpoint, "triples")
+        for table, is_literal in (("literals", "="), ("iris", "!=")):
+            if not TERM_FILES or phase_done(checkpoint, table):
+                continue
+            # The group by of a slice has to fit in memory, the slices are committed together
+            with metrics.phase("dictionary") as dictionary_metrics:
+                db_connection.execute("begin transaction")
+                id_range = key_range(
+                    db_connection,
+                    f"""staged_terms where substr(value, 1, 1) {is_literal} '"'""",
+                    "id",
+                    dense,
+                )
+                rows = [
+                    db_connection.execute(
+                        f"""insert into {table} select ANY_VALUE(id) as id, ANY_VALUE(value) from staged_terms where {hash_slice} and substr(value, 1, 1) {is_literal} '"' group by hash order by id """
+                    ).fetchone()[0]
+                    for hash_slice in hash_slices("id", partitions, id_range)
+                ]
+                check_slices(rows, table)
+                dictionary_metrics["rows"] += sum(rows)
+                db_connection.execute("commit")
+            mark_phase(checkpoint, table)
+
+    if not phase_done(checkpoint, "permutations"):
+        with metrics.phase("permutations") as permutations_metrics:
+            for table, order in PERMUTATIONS.items():
+                # In append mode the new triples were already added to existing copies
+                if mode == "append" and has_table(db_connection, table):
+                    continue
+                db_connection.execute("begin transaction")
+                db_connection.execute(
+                    f"create or replace table {table} (s ubigint, p ubigint, o ubigint, g ubigint)"
+                )
+                first_column = order.split(",")[0]
+                first_range = key_range(db_connection, "triples", first_column, dense)
+                rows = [
+                    db_connection.execute(
+                        f"insert into {table}(s,p,o,g) select s, p, o, g from triples where {hash_slice} order by {order}"
+                    ).fetchone()[0]
+                    for hash_slice in hash_slices(first_column, partitions, first_range)
+                ]
+                check_slices(rows, table)
+                permutations_metrics["rows"] += sum(rows)
+                db_connection.execute("commit")
+        mark_phase(checkpoint, "permutations")
+
+    if not phase_done(checkpoint, "fts_literals"):
+        # The DuckDB full-text indexes can not be updated in place, only rebuilt.
+        # In append mode, skip that when the new data did not add any literals.
+        has_fts_index = (
+            db_connection.execute(
+                "select count(*) from duckdb_schemas() where schema_name = 'fts_main_literals'"
+            ).fetchone()[0]
+            > 0
+        )
+        # Databases built before the postings were added have an index with settings that are
+        # not known, it is rebuilt so that the postings are stemmed the same way
+        if (
+            mode != "append"
+            or result.get("literals_inserted")
+            or not has_fts_index
+            or not has_table(db_connection, "literals_postings")
+        ):
+            with metrics.phase("fts") as fts_metrics:
+                settings = fts_settings(stemmer)
+                db_connection.execute(
+                    f"pragma create_fts_index('literals', 'hash', 'value', {settings}, overwrite=1)"
+                )
+                fts_metrics["rows"] += db_connection.execute(
+                    "select count(*) from literals"
+                ).fetchone()[0]
+                build_postings(db_connection, settings)
+        mark_phase(checkpoint, "fts_literals")
+
+    if BIKIDATA_TRIGRAMS and not phase_done(checkpoint, "trigrams"):
+        if (
+            mode != "append"
+            or result.get("literals_inserted")
+            or not has_table(db_connection, "literals_trigrams")
+        ):
+            with metrics.phase("trigrams") as trigram_metrics:
+                trigram_metrics["rows"] += build_trigrams(db_connection, partitions)
+        mark_phase(checkpoint, "trigrams")
+
+    if mode == "append" and not phase_done(checkpoint, "fts"):
+        if has_table(db_connection, "fts_changed"):
+            with metrics.phase("fts") as fts_metrics:
+                update_ftss(db_connection, "fts_changed", stemmer, partitions)
+                fts_metrics["rows"] += db_connection.execute(
+                    "select count(*) from fts_changed"
+                ).fetchone()[0]
+                db_connection.execute("drop table fts_changed")
+        mark_phase(checkpoint, "fts")
+
+    db_connection.commit()
+    DB.close()
+    return dict(result)
+
+
+def fts_rows(db_connection, subjects: str | None = None, partitions: int = 1):
+    """
+    Create the temp table temp_fts(s, values), the literals grouped per entity, plus the
+    literals of the entities it links to.
+    If subjects is the name of a table with an s column, only compute those entities.
+    The string_agg statements are run on partitions slices of the subjects.
+    """
+    if subjects:
+        scope = f"T.s IN (SELECT s FROM {subjects} UNION SELECT T2.o FROM triples T2 JOIN {subjects} X ON T2.s = X.s)"
+        top_scope = f"T.s IN (SELECT s FROM {subjects})"
+        fts1_scope = f"s IN (SELECT s FROM {subjects})"
+    else:
+        scope = top_scope = fts1_scope = "true"
+    # All of the slices are of entities, the subjects of triples
+    s_range = key_range(
+        db_connection, "triples", "s", has_table(db_connection, "terms")
+    )
+
     db_connection.execute(
-        """
-CREATE TEMPORARY TABLE temp_fts1 AS
+        "CREATE TEMPORARY TABLE temp_fts1 (s ubigint, values varchar)"
+    )
+    for hash_slice in hash_slices("T.s", partitions, s_range):
+        db_connection.execute(
+            f"""
+INSERT INTO temp_fts1
 WITH list_values AS (
   SELECT
     s, list_distinct(list(value)) AS value_list
   FROM
     triples T
     JOIN literals L ON T.o = L.hash
+  WHERE {scope} AND {hash_slice}
   GROUP BY s
 ),
 unnested AS (
@@ -252,21 +975,67 @@ SELECT
   string_agg(val, '\n') AS values
 FROM unnested GROUP BY s
 """
-    )
+        )
     db_connection.execute(
-        "CREATE TEMPORARY TABLE temp_fts2 AS SELECT T.s, string_agg(R.values, '\n') AS values FROM triples T JOIN temp_fts1 R ON T.o = R.s  GROUP BY T.s"
+        "CREATE TEMPORARY TABLE temp_fts2 (s ubigint, values varchar)"
     )
+    for hash_slice in hash_slices("T.s", partitions, s_range):
+        db_connection.execute(
+            f"INSERT INTO temp_fts2 SELECT T.s, string_agg(R.values, '\n') AS values FROM triples T JOIN temp_fts1 R ON T.o = R.s WHERE {top_scope} AND {hash_slice} GROUP BY T.s"
+        )
     db_connection.execute(
-        """
-CREATE TABLE fts AS select s, string_agg(values, '\t') AS values 
+        "CREATE TEMPORARY TABLE temp_fts (s ubigint, values varchar)"
+    )
+    for hash_slice in hash_slices("s", partitions, s_range):
+        db_connection.execute(
+            f"""
+INSERT INTO temp_fts select s, string_agg(values, '\t') AS values 
 FROM 
-    (SELECT s, values FROM temp_fts1 UNION SELECT s, values FROM temp_fts2) 
+    (SELECT s, values FROM temp_fts1 WHERE {fts1_scope} UNION SELECT s, values FROM temp_fts2) 
+WHERE {hash_slice}
 GROUP BY s
 """
-    )
+        )
+
+
+def update_ftss(
+    db_connection, subjects: str, stemmer: str = "porter", partitions: int = 1
+):
+    "Recompute the fts rows of the entities in the subjects table, and rebuild its index"
+    fts_rows(db_connection, subjects, partitions)
+    db_connection.execute(f"DELETE FROM fts WHERE s IN (SELECT s FROM {subjects})")
+    db_connection.execute("INSERT INTO fts SELECT s, values FROM temp_fts")
     db_connection.execute(
-        f"pragma create_fts_index('fts', 's', 'values', stemmer='{stemmer}')"
+        f"pragma create_fts_index('fts', 's', 'values', stemmer='{stemmer}', overwrite=1)"
     )
+
+
+def build_ftss(
+    stemmer: str = "porter",
+    progress_callback=None,
+    memory_limit: str | None = None,
+    threads: int | None = None,
+    temp_directory: str | None = None,
+    partitions: int | None = None,
+):
+    # For effective searches, the literals should be grouped by entity
+    start_time = time.time()
+    settings = build_settings(memory_limit, threads, temp_directory, partitions)
+    metrics = BuildMetrics(progress_callback, temp_paths(settings))
+
+    DB = connect_for_build(settings)
+    db_connection = DB.cursor()
+
+    with metrics.phase("fts") as fts_metrics:
+        fts_rows(db_connection, partitions=settings["partitions"])
+        fts_metrics["rows"] += db_connection.execute(
+            "CREATE TABLE fts AS SELECT s, values FROM temp_fts"
+        ).fetchone()[0]
+        db_connection.execute(
+            f"pragma create_fts_index('fts', 's', 'values', stemmer='{stemmer}')"
+        )
     db_connection.commit()
     end_time = time.time()
-    return {"duration": int(end_time - start_time)}
+    result = {"duration": int(end_time - start_time)}
+    result.update(metrics.report())
+    return result
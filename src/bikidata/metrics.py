@@ -0,0 +1,103 @@
+import os, sys, time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_rss_mb():
+    "Peak resident memory of this process, or of its largest child (the build workers), in MB"
+    if resource is None:
+        return None
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # ru_maxrss is in bytes on macOS, in kilobytes elsewhere
+    divider = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(peak / divider, 1)
+
+
+def disk_usage_mb(paths: list):
+    "Total size of the files in paths, which can be files or directories, in MB"
+    total = 0
+    for path in paths:
+        if not path:
+            continue
+        if os.path.isfile(path):
+            total += os.path.getsize(path)
+        for root, _, files in os.walk(path):
+            for filename in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, filename))
+                except OSError:
+                    pass  # removed while we were looking
+    return round(total / (1024 * 1024), 1)
+
+
+class BuildMetrics:
+    """
+    Collects per-phase metrics of a build: wall time, rows, rows/sec, bytes read,
+    peak RSS and the disk used in the temp_paths (staging and spill directories).
+    The progress_callback, if given, is called with a dict for the start, progress
+    and end of each phase: {"phase": name, "event": "start"|"progress"|"end", ...metrics}
+    """
+
+    def __init__(self, progress_callback=None, temp_paths: list | None = None):
+        self.progress_callback = progress_callback
+        self.temp_paths = temp_paths or []
+        self.phases = {}
+        self.peak_temp_disk_mb = 0
+
+    def get(self, name: str):
+        return self.phases.setdefault(
+            name, {"seconds": 0.0, "rows": 0, "bytes_read": 0}
+        )
+
+    def add(self, name: str, seconds: float = 0, rows: int = 0, bytes_read: int = 0):
+        "Account work done elsewhere, like in a worker process, to a phase"
+        m = self.get(name)
+        m["seconds"] += seconds
+        m["rows"] += rows
+        m["bytes_read"] += bytes_read
+
+    def snapshot(self, name: str):
+        m = dict(self.get(name))
+        m["seconds"] = round(m["seconds"], 3)
+        m["rows_per_sec"] = int(m["rows"] / m["seconds"]) if m["seconds"] > 0 else 0
+        m["peak_rss_mb"] = peak_rss_mb()
+        temp_disk_mb = disk_usage_mb(self.temp_paths)
+        self.peak_temp_disk_mb = max(self.peak_temp_disk_mb, temp_disk_mb)
+        m["temp_disk_mb"] = temp_disk_mb
+        return m
+
+    def emit(self, name: str, event: str, **extra):
+        # Also samples the temp disk usage, so that the peak is known without a callback
+        snapshot = self.snapshot(name)
+        if self.progress_callback is None:
+            return
+        info = {"phase": name, "event": event}
+        info.update(snapshot)
+        info.update(extra)
+        self.progress_callback(info)
+
+    @contextmanager
+    def phase(self, name: str):
+        "Time a block of work as (part of) a phase, the block can add to the yielded metrics"
+        self.emit(name, "start")
+        start_time = time.time()
+        try:
+            yield self.get(name)
+        finally:
+            self.get(name)["seconds"] += time.time() - start_time
+            self.emit(name, "end")
+
+    def report(self):
+        phases = {name: self.snapshot(name) for name in self.phases}
+        return {
+            "phases": phases,
+            "peak_rss_mb": peak_rss_mb(),
+            "peak_temp_disk_mb": self.peak_temp_disk_mb,
+        }
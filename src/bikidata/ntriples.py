@@ -0,0 +1,235 @@
+import re, logging
+
+log = logging.getLogger("bikidata")
+
+# Files are read in blocks of this many bytes, and tokenized one batch of lines at a time
+READ_SIZE = 16 * 1024 * 1024
+
+# See: https://www.w3.org/TR/n-triples/#grammar-production-UCHAR
+UNICODE_ESCAPE_PATTERN_U = re.compile(r"\\u([0-9a-fA-F]{4})")  # \uXXXX (4 hex digits)
+UNICODE_ESCAPE_PATTERN_UU = re.compile(
+    r"\\U([0-9a-fA-F]{8})"
+)  # \UXXXXXXXX (8 hex digits)
+
+
+def replace_unicode_escape(match):
+    # Convert hex to integer, then to Unicode character
+    return chr(int(match.group(1), 16))
+
+
+def decode_unicode_escapes(s):
+    if "\\" not in s:
+        return s
+    s = UNICODE_ESCAPE_PATTERN_UU.sub(replace_unicode_escape, s)
+    s = UNICODE_ESCAPE_PATTERN_U.sub(replace_unicode_escape, s)
+    return s
+
+
+def new_stats():
+    return {"lines": 0, "triples": 0, "quads": 0, "skipped": 0, "malformed": 0}
+
+
+def iter_line_batches(thefile, read_size: int = READ_SIZE, limit: int | None = None):
+    """
+    Read thefile in large blocks, and yield them as bytes holding only complete lines.
+    If limit is given, stop after that many bytes.
+    """
+    rest = b""
+    while True:
+        if limit is not None:
+            if limit <= 0:
+                break
+            block = thefile.read(min(read_size, limit))
+            limit -= len(block)
+        else:
+            block = thefile.read(read_size)
+        if not block:
+            break
+        block = rest + block
+        end = block.rfind(b"\n")
+        if end < 0:
+            rest = block
+            continue
+        rest = block[end + 1 :]
+        yield block[:end]
+    if rest:
+        yield rest
+
+
+def decode_batch(batch: bytes, stats: dict):
+    try:
+        return batch.decode("utf8").split("\n")
+    except UnicodeDecodeError:
+        lines = []
+        for line in batch.split(b"\n"):
+            try:
+                lines.append(line.decode("utf8"))
+            except UnicodeDecodeError:
+                stats["malformed"] += 1
+        return lines
+
+
+def skip_space(line: str, i: int):
+    while i < len(line) and line[i] in " \t":
+        i += 1
+    return i
+
+
+def end_of_term(line: str, i: int):
+    """
+    Return the index just past the RDF term starting at line[i], or -1 when there is none.
+    Handles <IRI>, _:blank and "literal" with an optional @lang or ^^<datatype>
+    """
+    if i >= len(line):
+        return -1
+    c = line[i]
+    if c == "<":
+        end = line.find(">", i + 1)
+        return -1 if end < 0 else end + 1
+    if c == "_" and line.startswith("_:", i):
+        end = i + 2
+        while end < len(line) and line[end] not in " \t":
+            end += 1
+        return end
+    if c == '"':
+        end = line.find('"', i + 1)
+        # skip over escaped quotes, an odd number of preceding backslashes
+        while end > 0:
+            backslashes = 0
+            while line[end - 1 - backslashes] == "\\":
+                backslashes += 1
+            if backslashes % 2 == 0:
+                break
+            end = line.find('"', end + 1)
+        if end < 0:
+            return -1
+        end += 1
+        if line.startswith("^^<", end):
+            end = line.find(">", end + 3)
+            return -1 if end < 0 else end + 1
+        if line.startswith("@", end):
+            end += 1
+            while end < len(line) and line[end] not in " \t":
+                end += 1
+        return end
+    return -1
+
+
+def tokenize_line(line: str):
+    """
+    Split one N-Triples or N-Quads statement into its terms.
+    Returns (s, p, o, g_or_None), or None when the line is malformed.
+    The trailing ' .' must already have been removed.
+    """
+    s_end = end_of_term(line, 0)
+    if s_end < 0 or line[0] == '"':
+        return None
+    p_start = skip_space(line, s_end)
+    if p_start == s_end or not line.startswith("<", p_start):
+        return None
+    p_end = end_of_term(line, p_start)
+    if p_end < 0:
+        return None
+    o_start = skip_space(line, p_end)
+    if o_start == p_end:
+        return None
+    o_end = end_of_term(line, o_start)
+    if o_end < 0:
+        return None
+    g = None
+    g_start = skip_space(line, o_end)
+    if g_start < len(line):
+        if g_start == o_end or line[g_start] == '"':
+            return None
+        g_end = end_of_term(line, g_start)
+        if g_end != len(line):
+            return None
+        g = line[g_start:g_end]
+    elif o_end != len(line):
+        return None
+    return line[:s_end], line[p_start:p_end], line[o_start:o_end], g
+
+
+def tokenize_simple_line(line: str):
+    """
+    Fast path for the overwhelmingly common shape of a dump line, single spaces
+    between an IRI or blank node subject, an IRI predicate and an object without a graph.
+    Returns None when the line is not of that shape, tokenize_line() then has to decide.
+    """
+    s_end = line.find(" ")
+    p_end = line.find(" ", s_end + 1)
+    if s_end < 1 or p_end < s_end + 3:
+        return None
+    s = line[:s_end]
+    p = line[s_end + 1 : p_end]
+    o = line[p_end + 1 :]
+    if not (s[0] == "<" and s[-1] == ">" or s.startswith("_:")):
+        return None
+    if p[0] != "<" or p[-1] != ">" or not o:
+        return None
+    first = o[0]
+    if first == "<":
+        if o[-1] == ">" and o.find(">") == len(o) - 1:
+            return s, p, o, None
+    elif first == '"':
+        quote = o.rfind('"')
+        if quote > 0 and o[quote - 1] != "\\":
+            tail = o[quote + 1 :]
+            if not tail or tail[0] == "@" and " " not in tail:
+                return s, p, o, None
+            if tail.startswith("^^<") and tail[-1] == ">" and " " not in tail:
+                return s, p, o, None
+    return None
+
+
+def tokenize_lines(line_batches, stats: dict | None = None, state: dict | None = None):
+    """
+    Yield (s, p, o, g) tuples from batches of N-Triples, N-Quads or simple .trig lines.
+    In .trig files, statements between '<IRI> {' and '}' get that graph.
+    Counts are kept in stats, see new_stats(), malformed lines are counted and skipped.
+    Pass the same state dict to tokenize a file in several calls, it keeps the current graph.
+    """
+    if stats is None:
+        stats = new_stats()
+    if state is None:
+        state = {}
+    graph = state.get("graph", "")
+    for batch in line_batches:
+        lines = decode_batch(batch, stats)
+        stats["lines"] += len(lines)
+        for line in lines:
+            line = line.strip()
+            if not line or line[0] == "#":
+                stats["skipped"] += 1
+                continue
+            if line[-1] != ".":
+                if line[-1] == "{" and line[0] == "<":
+                    graph = state["graph"] = line[:-1].strip()
+                    stats["skipped"] += 1
+                    continue
+                if line == "}":
+                    graph = state["graph"] = ""
+                    stats["skipped"] += 1
+                    continue
+                stats["malformed"] += 1
+                continue
+            line = line[:-1].rstrip()
+            terms = tokenize_simple_line(line) or tokenize_line(line)
+            if terms is None:
+                stats["malformed"] += 1
+                if stats["malformed"] <= 10:
+                    log.debug(f"Skipping malformed line: {line[:200]}")
+                continue
+            s, p, o, g = terms
+            if "\\" in line:
+                s = decode_unicode_escapes(s)
+                p = decode_unicode_escapes(p)
+                o = decode_unicode_escapes(o)
+                if g:
+                    g = decode_unicode_escapes(g)
+            if g is None:
+                stats["triples"] += 1
+                yield s, p, o, graph
+            else:
+                stats["quads"] += 1
+                yield s, p, o, g
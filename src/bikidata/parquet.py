@@ -0,0 +1,145 @@
+import os, glob, time
+import duckdb
+import xxhash
+from .main import log, hash_slices, key_range, has_table, build_settings, connect_for_build
+
+# Rows per Parquet row group, each group has min/max statistics DuckDB uses to skip it
+BIKIDATA_ROW_GROUP_SIZE = int(os.getenv("BIKIDATA_ROW_GROUP_SIZE", 122880))
+# Term maps written by the old scripts/map.py, named index.parquet in wikidata.md
+LEGACY_TERM_FILES = ("index.parquet", "map.parquet")
+
+
+def export_parquet(
+    parquet_path: str,
+    partitions: int | None = None,
+    row_group_size: int = BIKIDATA_ROW_GROUP_SIZE,
+):
+    """
+    Write the triples, iris and literals tables of DB_PATH to a directory of Parquet files
+    that can be queried with BIKIDATA_PARQUET_PATH:
+      triples/part-<n>.parquet  the triples in contiguous slices of s, sorted by s, p, o
+      iris.parquet, literals.parquet  sorted by hash
+      terms.parquet  the hash to id map of a database with dense ids, sorted by hash
+    Because of the sort order, the row group statistics let a lookup on s (or s and p)
+    skip all the files and row groups that can not contain it.
+    """
+    start_time = time.time()
+    settings = build_settings(partitions=partitions)
+    os.makedirs(os.path.join(parquet_path, "triples"), exist_ok=True)
+    for old_file in glob.glob(os.path.join(parquet_path, "triples", "part-*.parquet")):
+        os.unlink(old_file)
+
+    DB = connect_for_build(settings)
+    db_connection = DB.cursor()
+    options = f"format parquet, compression zstd, row_group_size {int(row_group_size)}"
+    files = []
+    s_range = key_range(
+        db_connection, "triples", "s", has_table(db_connection, "terms")
+    )
+    for idx, hash_slice in enumerate(
+        hash_slices("s", settings["partitions"], s_range)
+    ):
+        part_file = os.path.join(parquet_path, "triples", f"part-{idx:05d}.parquet")
+        db_connection.execute(
+            f"copy (select s, p, o, g from triples where {hash_slice} order by s, p, o) to '{part_file}' ({options})"
+        )
+        files.append(part_file)
+    for table in ("iris", "literals"):
+        table_file = os.path.join(parquet_path, f"{table}.parquet")
+        db_connection.execute(
+            f"copy (select hash, value from {table} order by hash) to '{table_file}' ({options})"
+        )
+        files.append(table_file)
+    terms_file = os.path.join(parquet_path, "terms.parquet")
+    if has_table(db_connection, "terms"):
+        db_connection.execute(
+            f"copy (select hash, id from terms order by hash) to '{terms_file}' ({options})"
+        )
+        files.append(terms_file)
+    elif os.path.exists(terms_file):
+        os.unlink(terms_file)
+    DB.close()
+    end_time = time.time()
+    return {"duration": int(end_time - start_time), "files": files}
+
+
+def file_list(paths: list):
+    return ", ".join(f"'{path}'" for path in paths)
+
+
+def columns_of(db_connection, paths: list):
+    return [
+        row[0]
+        for row in db_connection.execute(
+            f"describe select * from read_parquet([{file_list(paths)}])"
+        ).fetchall()
+    ]
+
+
+def create_views(db_connection, parquet_path: str):
+    """
+    Create the triples, iris and literals views over the Parquet files in parquet_path.
+    Reads the layout of export_parquet(), or the triple files of index_dump() and the
+    terms/*.parquet of map_dump(), or the single index.parquet term map of the old
+    scripts/map.py (see wikidata.md).
+    Triple files without a g column get the hash of the default graph ''.
+    """
+    if os.path.isdir(os.path.join(parquet_path, "triples")):
+        triple_files = sorted(glob.glob(os.path.join(parquet_path, "triples", "*.parquet")))
+        iri_files = [os.path.join(parquet_path, "iris.parquet")]
+        literal_files = [os.path.join(parquet_path, "literals.parquet")]
+        term_files = None
+    else:
+        term_files = [
+            os.path.join(parquet_path, name)
+            for name in LEGACY_TERM_FILES
+            if os.path.exists(os.path.join(parquet_path, name))
+        ] + sorted(glob.glob(os.path.join(parquet_path, "terms", "*.parquet")))
+        triple_files = sorted(
+            path
+            for path in glob.glob(os.path.join(parquet_path, "*.parquet"))
+            if os.path.basename(path) not in LEGACY_TERM_FILES
+        )
+    if not triple_files:
+        raise FileNotFoundError(f"No Parquet triple files found in {parquet_path}")
+
+    g = "g"
+    if "g" not in columns_of(db_connection, triple_files):
+        g = f"{xxhash.xxh64_intdigest('')}::ubigint as g"
+    db_connection.execute(
+        f"create or replace view triples as select s, p, o, {g} from read_parquet([{file_list(triple_files)}])"
+    )
+    if term_files is None:
+        db_connection.execute(
+            f"create or replace view iris as select hash, value from read_parquet([{file_list(iri_files)}])"
+        )
+        db_connection.execute(
+            f"create or replace view literals as select hash, value from read_parquet([{file_list(literal_files)}])"
+        )
+        terms_file = os.path.join(parquet_path, "terms.parquet")
+        if os.path.exists(terms_file):
+            db_connection.execute(
+                f"create or replace view terms as select hash, id from read_parquet(['{terms_file}'])"
+            )
+        return
+    if not term_files:
+        raise FileNotFoundError(
+            f"No terms/*.parquet, index.parquet or map.parquet found in {parquet_path}"
+        )
+    term_columns = columns_of(db_connection, term_files)
+    value = [name for name in term_columns if name != "hash"][0]
+    for table, is_literal in (("iris", "!="), ("literals", "=")):
+        db_connection.execute(
+            f"""create or replace view {table} as select hash, "{value}" as value from read_parquet([{file_list(term_files)}])
+            where substr("{value}", 1, 1) {is_literal} '"'"""
+        )
+
+
+def connect_parquet(parquet_path: str):
+    "An in-memory DuckDB connection with the triples, iris and literals views over parquet_path"
+    DB = duckdb.connect()
+    # The footers are read once, not for every query
+    DB.execute("SET parquet_metadata_cache = true")
+    create_views(DB, parquet_path)
+    log.debug(f"Querying the Parquet files in {parquet_path}")
+    return DB
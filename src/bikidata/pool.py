@@ -0,0 +1,133 @@
+import os, threading
+from contextlib import contextmanager
+import duckdb
+from .main import DB_PATH, BIKIDATA_PARQUET_PATH, log
+from .parquet import connect_parquet
+
+# Maximum number of queries running at the same time on the shared database
+BIKIDATA_POOL_SIZE = int(os.getenv("BIKIDATA_POOL_SIZE", 8))
+# By default the shared database stays open, so that the next queries find it warm.
+# While it is open, other processes can not write to DB_PATH. With BIKIDATA_POOL_IDLE set,
+# it is closed that many seconds after its last query, 0 closes it right away.
+BIKIDATA_POOL_IDLE = (
+    float(os.getenv("BIKIDATA_POOL_IDLE")) if os.getenv("BIKIDATA_POOL_IDLE") else None
+)
+
+
+def file_signature():
+    """
+    Changes when DB_PATH, or the Parquet files in BIKIDATA_PARQUET_PATH, are replaced or
+    modified. Only the files at the top of BIKIDATA_PARQUET_PATH and its directories are
+    checked, not the files inside them, a file that is added, removed or replaced in those
+    directories changes their modification time.
+    """
+    if BIKIDATA_PARQUET_PATH:
+        signature = []
+        with os.scandir(BIKIDATA_PARQUET_PATH) as entries:
+            for entry in entries:
+                if entry.is_dir() or entry.name.endswith(".parquet"):
+                    stat = entry.stat()
+                    signature.append((entry.name, stat.st_size, stat.st_mtime_ns))
+        return tuple(sorted(signature))
+    try:
+        stat = os.stat(DB_PATH)
+    except FileNotFoundError:
+        return None
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class ConnectionPool:
+    """
+    One read-only DuckDB instance per process, shared by the queries that run at the same
+    time, so that the catalog is loaded once and the buffer cache is shared between them.
+    Each query gets its own cursor, a light connection to the shared instance with its own
+    temp tables, and at most size cursors are in use at the same time.
+    The instance stays open, unless idle is set, then it is closed idle seconds after its
+    last cursor is returned, as its lock on DB_PATH keeps other processes, like the Redis
+    manager, from writing to it. Writes and builds in this process close() it first.
+    When the file at DB_PATH (or the Parquet files) is replaced, the next cursor comes
+    from a freshly opened instance. Queries still running on the old one can finish.
+    """
+
+    def __init__(
+        self, size: int = BIKIDATA_POOL_SIZE, idle: float | None = BIKIDATA_POOL_IDLE
+    ):
+        self.size = size
+        self.idle = idle
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+        self.DB = None
+        self.signature = None
+        self.in_use = 0
+        self.timer = None
+
+    def database(self):
+        "The shared connection, (re)opened when needed, call it with the lock held"
+        signature = file_signature()
+        if self.DB is not None and signature != self.signature:
+            log.debug("The database files changed, reopening the connection pool")
+            if self.in_use == 0:
+                self.DB.close()
+            self.DB = None
+        if self.DB is None:
+            if BIKIDATA_PARQUET_PATH:
+                self.DB = connect_parquet(BIKIDATA_PARQUET_PATH)
+            else:
+                self.DB = duckdb.connect(DB_PATH, read_only=True)
+            self.signature = signature
+        return self.DB
+
+    @contextmanager
+    def cursor(self):
+        with self.slots:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                db_cursor = self.database().cursor()
+                self.in_use += 1
+            try:
+                yield db_cursor
+            finally:
+                db_cursor.close()
+                with self.lock:
+                    self.in_use -= 1
+                    if self.in_use == 0 and self.idle is not None:
+                        if self.idle > 0:
+                            self.timer = threading.Timer(self.idle, self.release)
+                            self.timer.daemon = True
+                            self.timer.start()
+                        else:
+                            self.close_database()
+
+    def close_database(self):
+        "Close the shared connection, call it with the lock held and no cursors in use"
+        if self.DB is not None:
+            self.DB.close()
+            self.DB = None
+
+    def release(self):
+        "Close the shared connection if it is not in use, called after the idle time"
+        with self.lock:
+            if self.in_use == 0:
+                self.close_database()
+
+    def close(self):
+        """
+        Wait for the running queries, and close the shared connection.
+        Needed before DB_PATH can be opened for writing in this process.
+        """
+        for _ in range(self.size):
+            self.slots.acquire()
+        try:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                self.close_database()
+        finally:
+            for _ in range(self.size):
+                self.slots.release()
+
+
+POOL = ConnectionPool()
@@ -1,19 +1,254 @@
-import time, json, random, hashlib, os
-from .semantic import get_embedding, VEC_DIM
+import time, json, random, hashlib, os, re, base64
+from .semantic import get_embedding
 import xxhash
-from .main import DB_PATH, log
+import numpy as np
+import pandas as pd
+from .main import DB_PATH, BIKIDATA_PARQUET_PATH, PERMUTATIONS, log
+from .pool import POOL
+from .parquet import connect_parquet
+from .ivf import (
+    semantic_index,
+    BIKIDATA_SEMANTIC_K,
+    BIKIDATA_SEMANTIC_NPROBE,
+    BIKIDATA_SEMANTIC_RESCORE,
+)
 import duckdb
 
 
+def connect():
+    """
+    A read-only connection of its own to DB_PATH, or to the Parquet files in
+    BIKIDATA_PARQUET_PATH. The query functions use the shared one in pool.py instead.
+    """
+    if BIKIDATA_PARQUET_PATH:
+        return connect_parquet(BIKIDATA_PARQUET_PATH)
+    return duckdb.connect(DB_PATH, read_only=True)
+
+
+# Without the PERMUTATIONS tables, for example over Parquet files, every lookup uses triples
+TRIPLES_ONLY = {"spo": "triples", "pos": "triples", "osp": "triples"}
+
+
+def triple_tables(db_cursor):
+    """
+    The tables to use for lookups led by s ("spo"), by p and o ("pos") and by o ("osp"),
+    the postings of the full-text index ("fts"), see main.build_postings(), and the
+    trigrams of the literals ("trigrams"), see main.build_trigrams().
+    Databases built before the PERMUTATIONS or the postings were added only have triples.
+    """
+    existing = {
+        row[0]
+        for row in db_cursor.execute(
+            "select table_name from duckdb_tables() where not temporary"
+        ).fetchall()
+    }
+    tables = dict(TRIPLES_ONLY)
+    for table in PERMUTATIONS:
+        if table in existing:
+            tables[table.split("_")[1]] = table
+    if "literals_postings" in existing:
+        tables["fts"] = "literals_postings"
+    if "literals_trigrams" in existing:
+        tables["trigrams"] = "literals_trigrams"
+    return tables
+
+
+def dense_ids(db_cursor):
+    "Does the database store terms by dense ids, with a terms(hash, id) table, see main.load_staging()"
+    return (
+        db_cursor.execute(
+            "select count(*) from information_schema.tables where table_schema = 'main' and table_name = 'terms'"
+        ).fetchone()[0]
+        > 0
+    )
+
+
+def term_ids(db_cursor, keys, add: bool = False):
+    """
+    Map '0x...' hash strings to the dense ids of the terms.
+    With add=True, terms that do not have an id yet get the next free ones.
+    """
+    keys = list(set(keys))
+    ids = {}
+    if keys:
+        ids = dict(
+            db_cursor.execute(
+                "select K.key, T.id from (select unnest(?::varchar[]) as key) K join terms T on T.hash = K.key::ubigint",
+                [keys],
+            ).fetchall()
+        )
+    missing = [key for key in keys if key not in ids]
+    if add and missing:
+        next_id = db_cursor.execute(
+            "select coalesce(max(id), 0) + 1 from terms"
+        ).fetchone()[0]
+        new_ids = [(key, next_id + idx) for idx, key in enumerate(missing)]
+        db_cursor.executemany(
+            "insert into terms (hash, id) values (?::ubigint, ?)", new_ids
+        )
+        ids.update(new_ids)
+    return ids
+
+
+class TermHash(int):
+    "The xxhash of a term, as a query parameter, see bind()"
+
+
+def term_hash(term: str):
+    return TermHash(xxhash.xxh64_intdigest(term))
+
+
+def bind(db_cursor, params: dict, dense: bool):
+    """
+    The queries are generated with named parameters, $name in the SQL, the terms in them
+    as TermHash. In a database with dense ids, those become the ids, or NULL for unknown terms.
+    """
+    if not dense:
+        return {
+            name: int(value) if isinstance(value, TermHash) else value
+            for name, value in params.items()
+        }
+    keys = {
+        name: f"0x{value:016x}"
+        for name, value in params.items()
+        if isinstance(value, TermHash)
+    }
+    ids = term_ids(db_cursor, keys.values())
+    return {
+        name: ids.get(keys[name]) if name in keys else value
+        for name, value in params.items()
+    }
+
+
+PARAMETER = re.compile(r"\$(\w+)")
+
+
+def execute(db_cursor, SQL: str, params: dict, dense: bool):
+    "Execute SQL with the params it uses, DuckDB refuses parameters that are not in the statement"
+    names = set(PARAMETER.findall(SQL))
+    used = {name: value for name, value in params.items() if name in names}
+    return db_cursor.execute(SQL, bind(db_cursor, used, dense))
+
+
+def value_list(name: str, values: list, params: dict):
+    "Add the values to params as $name_0, $name_1, ..., and return the SQL list of them"
+    for idx, value in enumerate(values):
+        params[f"{name}_{idx}"] = value
+    return ", ".join(f"${name}_{idx}" for idx in range(len(values)))
+
+
+def term_list(name: str, terms: list, params: dict):
+    "Add the terms to params as $name_0, $name_1, ..., and return the SQL list of them"
+    names = []
+    for idx, term in enumerate(terms):
+        params[f"{name}_{idx}"] = term_hash(term)
+        names.append(f"${name}_{idx}::ubigint")
+    return ", ".join(names)
+
+
+def seek_sql(columns: list[str], alias: str = "T"):
+    """
+    The condition for the rows that come after ($after_<column>, ...) when ordered by
+    columns, for keyset pagination. The first column is also compared on its own, so that
+    the scan of a table sorted by it can skip the row groups before the cursor.
+    """
+    condition = None
+    for column in reversed(columns):
+        after = f"$after_{column}::ubigint"
+        greater = f"{alias}.{column} > {after}"
+        condition = (
+            greater
+            if condition is None
+            else f"({greater} or ({alias}.{column} = {after} and {condition}))"
+        )
+    return f"{alias}.{columns[0]} >= $after_{columns[0]}::ubigint and {condition}"
+
+
+def query_key(*parts):
+    "Identifies the query a cursor was made for"
+    return hashlib.md5(
+        json.dumps(parts, sort_keys=True, default=str).encode()
+    ).hexdigest()[:16]
+
+
+def encode_cursor(key: dict):
+    "The opaque cursor for the next page, key holds the sort key of the last result"
+    return base64.urlsafe_b64encode(
+        json.dumps(key, separators=(",", ":")).encode()
+    ).decode()
+
+
+def decode_cursor(cursor: str, kind: str, for_query: str):
+    "The key in cursor, which must come from a page of the same kind and query"
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError, AttributeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(key, dict) or key.get("k") != kind or key.get("q") != for_query:
+        raise ValueError("The cursor was made for a different query")
+    return key
+
+
+# Up to this many terms are looked up with a list of constants, so that the scans of iris
+# and literals, sorted by hash, can skip the row groups that do not hold them. Larger sets
+# touch most row groups anyway, and are joined as a registered array instead.
+HYDRATE_IN_LIMIT = 512
+
+
+class TermValues:
+    "The values of a set of terms, looked up by hash (or dense id) for whole arrays at once"
+
+    def __init__(self, keys, values):
+        self.keys = keys
+        self.values = values
+
+    def lookup(self, hashes):
+        "The values for an array of hashes, None for the ones that are not known"
+        if len(self.keys) == 0:
+            return np.full(len(hashes), None, dtype=object)
+        hashes = np.asarray(hashes, dtype=self.keys.dtype)
+        idx = np.minimum(np.searchsorted(self.keys, hashes), len(self.keys) - 1)
+        return np.where(self.keys[idx] == hashes, self.values[idx], None)
+
+    def get(self, key, default=None):
+        key = np.asarray(key, dtype=self.keys.dtype)
+        idx = np.searchsorted(self.keys, key)
+        if idx < len(self.keys) and self.keys[idx] == key:
+            return self.values[idx]
+        return default
+
+
+def term_values(db_cursor, hashes):
+    "Fetch the values in iris and literals of the terms in the array hashes"
+    wanted = np.unique(hashes)
+    if len(wanted) == 0:
+        return TermValues(wanted, np.array([], dtype=object))
+    if len(wanted) <= HYDRATE_IN_LIMIT:
+        constants = ", ".join(str(x) for x in wanted.tolist())
+        found = db_cursor.execute(
+            f"(select hash, value from iris where hash in ({constants})) union all (select hash, value from literals where hash in ({constants}))"
+        ).fetchnumpy()
+    else:
+        db_cursor.register("wanted_terms", pd.DataFrame({"hash": wanted}))
+        try:
+            found = db_cursor.execute(
+                "select hash, value from iris semi join wanted_terms using (hash) union all select hash, value from literals semi join wanted_terms using (hash)"
+            ).fetchnumpy()
+        finally:
+            db_cursor.unregister("wanted_terms")
+    keys = np.asarray(found["hash"])
+    order = np.argsort(keys, kind="stable")
+    return TermValues(keys[order], np.asarray(found["value"], dtype=object)[order])
+
+
 def raw():
-    DB = duckdb.connect(DB_PATH, read_only=True)
-    return DB.cursor()
+    "A cursor on a connection of its own, close it when done"
+    return connect().cursor()
 
 
 def total():
-    DB = duckdb.connect(DB_PATH, read_only=True)
-    db_cursor = DB.cursor()
-    total = db_cursor.execute("select count(distinct s) from triples").fetchone()[0]
+    with POOL.cursor() as db_cursor:
+        total = db_cursor.execute("select count(distinct s) from triples").fetchone()[0]
     return total
 
 
@@ -22,69 +257,130 @@ def properties():
     Returns a list of all properties in the database.
     """
     SQL = "select distinct I.value, count(distinct s) from triples T join iris I on T.p = I.hash group by I.value"
-    DB = duckdb.connect(DB_PATH, read_only=True)
-    db_cursor = DB.cursor()
-    return dict(db_cursor.execute(SQL).fetchall())
+    with POOL.cursor() as db_cursor:
+        return dict(db_cursor.execute(SQL).fetchall())
 
 
 def count_by_property(property):
     SQL = "select I.value, count(distinct s) from triples T join iris I on T.o = I.hash join iris II on T.p = II.hash where II.value = ? group by I.value"
-    DB = duckdb.connect(DB_PATH, read_only=True)
-    db_cursor = DB.cursor()
-
-    return dict(db_cursor.execute(SQL, (property,)).fetchall())
+    with POOL.cursor() as db_cursor:
+        return dict(db_cursor.execute(SQL, (property,)).fetchall())
 
 
 def sp(s: list[str], p: str | None):
     "For a list of subjects s,  and a predicates p, return the triples where s and p match"
     if not isinstance(s, list):
         raise TypeError("s must be a list of strings")
-    ss = [xxhash.xxh64_hexdigest(x).lower() for x in s]
-    sss = ",".join(f"'0x{x}'::ubigint" for x in ss)
-    where = (
-        f"where U.hash in ({sss}) and UU.hash = '0x{xxhash.xxh64_hexdigest(p).lower()}'::ubigint"
-        if p
-        else f"where U.hash in ({sss})"
-    )
+    params = {}
+    sss = term_list("s", s, params)
+    # Filtering on T.s too, so that the scan of triples can skip row groups
+    where = f"where T.s in ({sss}) and U.hash in ({sss})"
+    if p:
+        params["p"] = term_hash(p)
+        where += " and UU.hash = $p::ubigint"
 
     SQL = f"select U.value, UU.value, UUU.value, L.value from triples T left join iris U on T.s = U.hash left join iris UU on T.p = UU.hash left join iris UUU on T.o = UUU.hash left join literals L on T.o = L.hash {where}"
 
-    DB = duckdb.connect(DB_PATH, read_only=True)
-    db_cursor = DB.cursor()
     data = {}
-    for s, p, o, oo in db_cursor.execute(SQL).fetchall():
-        data.setdefault(s, []).append(o if o else oo)
+    with POOL.cursor() as db_cursor:
+        params = bind(db_cursor, params, dense_ids(db_cursor))
+        for s, p, o, oo in db_cursor.execute(SQL, params).fetchall():
+            data.setdefault(s, []).append(o if o else oo)
     return data
 
 
-def spo(*args, **kwargs):
-    """
-    Returns triples with the given subject, predicate, and object.
-    """
+def spo_conditions(args, params: dict, tables: dict):
+    "The table to read and the conditions for the s, p, o and g in args that are not None"
     vals = {}
     for i, t in enumerate(args):
         if t is not None:
             if not isinstance(t, str):
                 raise TypeError("s, p, and o must be strings or None")
-            vals[i] = xxhash.xxh64_hexdigest(t).lower() if t else None
+            vals[i] = term_hash(t) if t else None
 
     conditions = []
     for i, t in enumerate(("s", "p", "o", "g")):
         tt = vals.get(i)
         if tt:
-            conditions.append(f"{t} = '0x{tt}'::ubigint")
+            conditions.append(f"T.{t} = ${t}::ubigint")
+            params[t] = tt
 
-    size = kwargs.get("size", 1000)
-    start = kwargs.get("start", 0)
-    start = "" if start == 0 else f" offset {start}"
+    if vals.get(0) or not (vals.get(1) or vals.get(2)):
+        table = tables["spo"]
+    elif vals.get(1):
+        table = tables["pos"]
+    else:
+        table = tables["osp"]
+    return table, conditions
 
-    conditions_ = " and ".join(conditions)
-    where = f" where {conditions_}" if conditions_ else ""
-    SQL = f"select U.value, UU.value, UUU.value, L.value from triples T left join iris U on T.s = U.hash left join iris UU on T.p = UU.hash left join iris UUU on T.o = UUU.hash left join literals L on T.o = L.hash{where}{start} limit {size}"
 
-    DB = duckdb.connect(DB_PATH, read_only=True)
-    db_cursor = DB.cursor()
-    return [(s, p, o if o else oo) for s, p, o, oo in db_cursor.execute(SQL).fetchall()]
+# The order of the rows in each table, with g to make the keys of the cursors unique
+TABLE_ORDER = {
+    "triples": ["s", "p", "o", "g"],
+    "triples_pos": ["p", "o", "s", "g"],
+    "triples_osp": ["o", "s", "p", "g"],
+}
+
+
+def spo(*args, **kwargs):
+    """
+    Returns triples with the given subject, predicate, and object.
+    To walk through many triples, use spo_page(), which does not slow down on deep pages.
+    """
+    params = {
+        "size": int(kwargs.get("size", 1000)),
+        "start": int(kwargs.get("start", 0)),
+    }
+    with POOL.cursor() as db_cursor:
+        table, conditions = spo_conditions(args, params, triple_tables(db_cursor))
+        conditions_ = " and ".join(conditions)
+        where = f" where {conditions_}" if conditions_ else ""
+        SQL = f"select U.value, UU.value, UUU.value, L.value from {table} T left join iris U on T.s = U.hash left join iris UU on T.p = UU.hash left join iris UUU on T.o = UUU.hash left join literals L on T.o = L.hash{where} limit $size offset $start"
+        params = bind(db_cursor, params, dense_ids(db_cursor))
+
+        return [
+            (s, p, o if o else oo)
+            for s, p, o, oo in db_cursor.execute(SQL, params).fetchall()
+        ]
+
+
+def spo_page(*args, size: int = 1000, cursor: str | None = None):
+    """
+    Like spo(), one page of size triples, in the order of the table that is read.
+    Returns {"results": [(s, p, o), ...], "cursor": ...}, pass the cursor to get the next
+    page, it is None after the last one. Each page seeks to where the previous one ended,
+    instead of skipping the rows before it.
+    """
+    params = {"size": int(size)}
+    with POOL.cursor() as db_cursor:
+        table, conditions = spo_conditions(args, params, triple_tables(db_cursor))
+        order = TABLE_ORDER[table]
+        for_query = query_key(args)
+        if cursor:
+            key = decode_cursor(cursor, table, for_query)
+            for column, value in zip(order, key["after"]):
+                params[f"after_{column}"] = value
+            conditions.append(seek_sql(order))
+        conditions_ = " and ".join(conditions)
+        where = f" where {conditions_}" if conditions_ else ""
+        order_sql = ", ".join(f"T.{column}" for column in order)
+        # The page is selected before the joins, so that only its rows are looked up
+        SQL = f"""select T.{', T.'.join(order)}, U.value, UU.value, UUU.value, L.value
+            from (select * from {table} T{where} order by {order_sql} limit $size) T
+            left join iris U on T.s = U.hash left join iris UU on T.p = UU.hash
+            left join iris UUU on T.o = UUU.hash left join literals L on T.o = L.hash
+            order by {order_sql}"""
+        rows = execute(db_cursor, SQL, params, dense_ids(db_cursor)).fetchall()
+
+    next_cursor = None
+    if rows and len(rows) == params["size"]:
+        next_cursor = encode_cursor(
+            {"k": table, "q": for_query, "after": list(rows[-1][:4])}
+        )
+    return {
+        "results": [(s, p, o if o else oo) for *_, s, p, o, oo in rows],
+        "cursor": next_cursor,
+    }
 
 
 def parse_hops_and_prop(p_str: str) -> tuple[int, str | None]:
@@ -92,6 +388,7 @@ def parse_hops_and_prop(p_str: str) -> tuple[int, str | None]:
     Parse patterns like:
       'fts', 'fts 1', 'fts <iri>', 'fts 2 <iri>'
       'regex', 'regex 1', 'regex <iri>', 'regex 2 <iri>'
+      'like', 'like 1', 'like <iri>', 'like 2 <iri>'
     Returns (hops, prop_iri_or_none, p_without_hop).
     """
     toks = (p_str or "").split()
@@ -107,50 +404,207 @@ def parse_hops_and_prop(p_str: str) -> tuple[int, str | None]:
     return hops, prop, toks[0] if toks else ""
 
 
-def join_parents_sql(hops: int) -> str:
+def join_parents_sql(hops: int, table: str = "triples") -> str:
     """
     Build the 'parents' join chain:
       T0 ... join T1 on T0.s = T1.o ... join Tn on T{n-1}.s = Tn.o
+    The joins are on o, so table is best the one clustered by o.
     """
     if hops <= 0:
         return ""
     return "\n".join(
-        f"join triples T{idx+1} on T{idx}.s = T{idx+1}.o" for idx in range(hops)
+        f"join {table} T{idx+1} on T{idx}.s = T{idx+1}.o" for idx in range(hops)
     )
 
 
-def q_to_sql(query: dict):
+# The parameters of the BM25 scores of fts_main_literals.match_bm25()
+BM25_K = 1.2
+BM25_B = 0.75
+
+
+def fts_postings_sql(name: str, postings: str, scored: bool = True):
+    """
+    The select of the literals that hold all the terms of ${name}_text, as (hash, score)
+    with the score of fts_main_literals.match_bm25(), or as (hash) when scored is False.
+    Only the postings of those terms are read, postings is sorted by termid.
+    """
+    score = ""
+    if scored:
+        idf = "log(((select num_docs from fts_main_literals.stats) - Q.df + 0.5) / (Q.df + 0.5) + 1)"
+        norm = f"{BM25_K} * (1 - {BM25_B} + {BM25_B} * P.len / (select avgdl from fts_main_literals.stats))"
+        score = f", sum({idf} * P.tf * {BM25_K + 1} / (P.tf + {norm})) as score"
+    return f"""select P.hash{score}
+        from {postings} P
+        join fts_main_literals.dict Q on P.termid = Q.termid
+        where Q.term in (select unnest(literals_query_terms(${name}_text)))
+        group by P.docid, P.hash
+        having count(*) = len(literals_query_terms(${name}_text))"""
+
+
+# Patterns are looked up with at most this many of their trigrams, see pattern_trigrams(),
+# and the literals are read for the rarest TRIGRAMS_LOOKED_UP of them
+TRIGRAMS_PER_PATTERN = 16
+TRIGRAMS_LOOKED_UP = 3
+# The escapes of RE2 that match a class of characters or a position
+REGEX_CLASSES = "dDsSwWbBAz"
+REGEX_REPEAT = re.compile(r"\{(\d*)(,\d*)?\}")
+# The named classes, collating elements and equivalence classes inside a [...] class
+REGEX_NESTED_CLASS = re.compile(r"\[([:.=]).*?\1\]")
+
+
+def regex_runs(pattern: str):
+    """
+    The runs of characters that every value matched by the regular expression pattern, a
+    full match as with SIMILAR TO, holds. Only the top level of the pattern is read, the
+    groups and classes end a run, and there are none when the top level has alternatives.
+    Constructs that are not understood stop the reading, the runs before them still hold.
+    """
+    runs, run = [], ""
+    depth, idx = 0, 0
+    while idx < len(pattern):
+        char = pattern[idx]
+        idx += 1
+        if char == "\\":
+            escaped = pattern[idx : idx + 1]
+            idx += 1
+            if escaped in REGEX_CLASSES:
+                runs.append(run)
+                run = ""
+                continue
+            if not escaped or escaped.isalnum() or not escaped.isascii():
+                break
+            char = escaped
+        elif char == "[":
+            # Skip the class, a ] right after [ or [^ is one of its characters,
+            # and so is the ] that ends a [:alpha:], [.x.] or [=x=] inside it
+            idx += 1 if pattern[idx : idx + 1] == "^" else 0
+            idx += 1 if pattern[idx : idx + 1] == "]" else 0
+            while idx < len(pattern) and pattern[idx] != "]":
+                nested = REGEX_NESTED_CLASS.match(pattern, idx)
+                if nested:
+                    idx = nested.end()
+                    continue
+                idx += 2 if pattern[idx] == "\\" else 1
+            if idx >= len(pattern):
+                break
+            idx += 1
+            runs.append(run)
+            run = ""
+            continue
+        elif char == "|":
+            if depth == 0:
+                return []
+            continue
+        elif char in "().^$*+?{":
+            depth += {"(": 1, ")": -1}.get(char, 0)
+            repeat = REGEX_REPEAT.match(pattern, idx - 1)
+            idx = repeat.end() if repeat else idx
+            runs.append(run)
+            run = ""
+            continue
+        if depth > 0:
+            continue
+        # The character is required unless it is repeated zero or more times
+        repeat = REGEX_REPEAT.match(pattern, idx)
+        if pattern[idx : idx + 1] in ("*", "?") or (repeat and not int(repeat.group(1) or 0)):
+            runs.append(run)
+            run = ""
+        elif pattern[idx : idx + 1] == "+" or repeat:
+            runs.append(run + char)
+            run = ""
+        else:
+            run += char
+            continue
+        idx = repeat.end() if repeat else idx
+    runs.append(run)
+    return runs
+
+
+def pattern_trigrams(pattern: str, regex: bool = True):
+    """
+    The trigram codes of main.build_trigrams() that every value matched by the regex, or
+    by the like pattern when regex is False, holds. A value can only match when it has all
+    of them, an empty list means that the pattern can not be looked up by its trigrams.
+    """
+    if regex:
+        runs = regex_runs(pattern)
+        # With (?i) RE2 also matches the s in a pattern with ſ, which lower() keeps
+        folded = re.search(r"\(\?[a-zA-Z]*i", pattern) is not None
+    else:
+        runs = re.split("[%_]", pattern)
+        folded = False
+    codes = []
+    for run in sorted(runs, key=len, reverse=True):
+        run = run.lower()
+        for idx in range(len(run) - 2):
+            trigram = run[idx : idx + 3]
+            if not trigram.isascii() or (folded and "s" in trigram):
+                continue
+            code = ord(trigram[0]) * 16384 + ord(trigram[1]) * 128 + ord(trigram[2])
+            if code not in codes:
+                codes.append(code)
+    return codes[:TRIGRAMS_PER_PATTERN]
+
+
+def trigram_candidates_sql(name: str, codes: list, params: dict):
+    """
+    The select of the hashes of the literals that hold all the trigram codes, from
+    literals_trigrams. Only the postings of the TRIGRAMS_LOOKED_UP rarest codes are read,
+    and none when one of the codes is not in any literal.
+    """
+    for idx, code in enumerate(codes):
+        params[f"{name}_trigram_{idx}"] = code
+    trigrams = ", ".join(f"${name}_trigram_{idx}::uinteger" for idx in range(len(codes)))
+    rarest = min(TRIGRAMS_LOOKED_UP, len(codes))
+    return f"""with N as materialized (
+            select trigram, count(*) as n from literals_trigrams where trigram in ({trigrams}) group by trigram
+        )
+        select hash from literals_trigrams
+        where trigram in (select trigram from N order by n limit {rarest})
+        group by hash
+        having count(*) = {rarest} and (select count(*) from N) = {len(codes)}"""
+
+
+# A semantic filter matches the entities with a cosine distance to its text below this
+SEMANTIC_DISTANCE = 0.5
+
+
+def q_to_sql(query: dict, tables: dict = TRIPLES_ONLY, name: str = "q"):
+    """
+    Returns (SQL, params) for one filter, or None when the filter is not understood.
+    The values are bound as named parameters, $<name>_..., so pass a different name for
+    each filter that goes in the same statement. The SQL only depends on the shape of the
+    filter, not on the values. tables are the triple tables to use per type of lookup, see triple_tables()
+    """
+    spo_table, pos_table, osp_table = tables["spo"], tables["pos"], tables["osp"]
     p = str(query.get("p", "")).strip(" ")
     o = str(query.get("o", "")).strip(" ")
     g = str(query.get("g", "")).strip(" ")
+    params = {}
 
     # Allow adding an n-hop to the p, e.g. "<iri> 2"
     # If the p has a space in it, the second part is an n-hop and should be removed
     parents, p_property, p_without_hop = parse_hops_and_prop(p)
-    pp = xxhash.xxh64_hexdigest(p_without_hop).lower()
-
-    gg = [xxhash.xxh64_hexdigest(g_).lower() for g_ in g.split(" ")]
 
     if o.startswith("<") and o.endswith(">") and len(o.split(" ")) > 1:
-        oo = ", ".join(
-            [
-                "'0x" + xxhash.xxh64_hexdigest(multi_o).lower() + "'::ubigint"
-                for multi_o in o.split(" ")
-            ]
-        )
-        oo = f" in ({oo})"
+        oo = f" in ({term_list(f'{name}_o', o.split(' '), params)})"
     else:
-        oo = xxhash.xxh64_hexdigest(o).lower()
-        oo = f" = '0x{oo}'::ubigint"
+        params[f"{name}_o"] = term_hash(o)
+        oo = f" = ${name}_o::ubigint"
     extra_g = ""
     if g != "":
-        g_hashes = ", ".join([f"'0x{ggg}'::ubigint" for ggg in gg])
-        extra_g = f" and T0.g in ({g_hashes})"
+        extra_g = f" and T0.g in ({term_list(f'{name}_g', g.split(' '), params)})"
 
     extra_fts_fields = query.get("_extra_fts_fields", "")
 
+    # optional restriction of fts, regex and like to a specific child literal property
+    prop_filter = ""
+    if p_property and (p.startswith("regex") or p.startswith("like") or p.startswith("fts")):
+        params[f"{name}_prop"] = term_hash(p_property)
+        prop_filter = f" and T0.p = ${name}_prop::ubigint"
+
     if p == "" and (o.startswith("<") or o.startswith("_:")):
-        return f"(select distinct s from triples T0 where o{oo} {extra_g})"
+        return f"(select distinct s from {osp_table} T0 where o{oo} {extra_g})", params
     elif p == "id":
         if o.startswith("random") or o.startswith("sample"):
             o_split = o.split(" ")
@@ -161,72 +615,115 @@ def q_to_sql(query: dict):
                     o_count = int(o_split[1])
                 except ValueError:
                     o_count = 1
-            return f"(select distinct s from triples using sample {o_count} {extra_g})"
-        return f"(select distinct s from triples where s{oo} {extra_g})"
+            del params[f"{name}_o"]
+            return (
+                f"(select distinct s from triples T0 using sample {o_count} {extra_g})",
+                params,
+            )
+        return f"(select distinct s from {spo_table} T0 where s{oo} {extra_g})", params
     elif p.startswith("semantic"):
         # convert the o to a vector
-        q_vector = get_embedding(o)
-        return f"""(select distinct s{extra_fts_fields} from (select T0.s, array_cosine_distance(vec, CAST({q_vector} AS FLOAT[{VEC_DIM}])) as distance, 1/distance as score from literals_semantic LS join triples T0 on T0.s = LS.hash where distance < 0.5 {extra_g}))
-        """
-
-    elif p.startswith("regex"):
-        prop_filter = ""
-        if p_property:
-            p_property_hash = xxhash.xxh64_hexdigest(p_property).lower()
-            prop_filter = f" and T0.p = '0x{p_property_hash}'::ubigint"
+        del params[f"{name}_o"]
+        vector = get_embedding(o)
+        index = semantic_index()
+        if index is not None:
+            # The nearest vectors from the IVF index, the k, nprobe and rescore of the filter tune it
+            hashes, distances = index.search(
+                vector,
+                int(query.get("k", BIKIDATA_SEMANTIC_K)),
+                int(query.get("nprobe", BIKIDATA_SEMANTIC_NPROBE)),
+                SEMANTIC_DISTANCE,
+                int(query.get("rescore", BIKIDATA_SEMANTIC_RESCORE)),
+            )
+            params[f"{name}_hashes"] = hashes.tolist()
+            params[f"{name}_distances"] = distances.tolist()
+            nearest = f"select unnest(${name}_hashes::ubigint[]) as hash, unnest(${name}_distances::double[]) as distance"
+        else:
+            params[f"{name}_vector"] = vector
+            nearest = f"""select * from (
+                select hash, array_cosine_distance(vec, ${name}_vector::FLOAT[{len(vector)}]) as distance from literals_semantic
+            ) where distance < {SEMANTIC_DISTANCE}"""
+        return (
+            f"""(select distinct s{extra_fts_fields} from (select T0.s, distance, 1/distance as score from ({nearest}) LS join triples T0 on T0.s = LS.hash where 1=1 {extra_g}))
+        """,
+            params,
+        )
 
-        joins = join_parents_sql(parents)
+    elif p.startswith("regex") or p.startswith("like"):
+        del params[f"{name}_o"]
+        params[f"{name}_pattern"] = o
+        regex = p.startswith("regex")
+        matches = "similar to" if regex else "like"
+        joins = join_parents_sql(parents, osp_table)
+        # Only the literals that hold the trigrams of the pattern are matched with it.
+        # The limit keeps DuckDB from matching all the literals in the scan of literals.
+        literals = "literals"
+        codes = pattern_trigrams(o, regex)
+        if tables.get("trigrams") and codes:
+            literals = f"""(
+                select L.hash, L.value
+                from ({trigram_candidates_sql(name, codes, params)}) C
+                join literals L on L.hash = C.hash
+                limit {2**63 - 1}
+            )"""
         psql = f"""(
             select distinct T{parents}.s
-            from triples T0
-            join literals L on T0.o = L.hash
+            from {osp_table} T0
+            join {literals} L on T0.o = L.hash
             {joins}
-            where L.value similar to '{o}'{prop_filter}{extra_g}
+            where L.value {matches} ${name}_pattern{prop_filter}{extra_g}
         )"""
-        return psql
+        return psql, params
     elif p.startswith("fts"):
+        del params[f"{name}_o"]
+        params[f"{name}_text"] = o
 
         # parents-join chain (parents >= 1 travels up to ancestors)
-        joins = join_parents_sql(parents)
-
-        # optional restriction to a specific child literal property
-        prop_filter = ""
-        if p_property:
-            p_property_hash = xxhash.xxh64_hexdigest(p_property).lower()
-            prop_filter = f" and T0.p = '0x{p_property_hash}'::ubigint"
-
-        psql = f"""(
-            with scored as (
-                select *,
-                       fts_main_literals.match_bm25(hash, '{o}', conjunctive:=1) AS score
+        joins = join_parents_sql(parents, osp_table)
+
+        if tables.get("fts") and query.get("_fts_limit"):
+            # Only the best literals, with all those that have the same score as the last one
+            params[f"{name}_limit"] = int(query["_fts_limit"])
+            matches = f"""with M as materialized ({fts_postings_sql(name, tables["fts"])})
+                select * from M where score >= (
+                    select min(score) from (select score from M order by score desc limit ${name}_limit)
+                )"""
+        elif tables.get("fts"):
+            matches = fts_postings_sql(name, tables["fts"], scored=bool(extra_fts_fields))
+        else:
+            matches = f"""select * from (
+                select hash, fts_main_literals.match_bm25(hash, ${name}_text, conjunctive:=1) AS score
                 from literals
-            )
+            ) where score is not null"""
+        psql = f"""(
             select distinct T{parents}.s{extra_fts_fields}
-            from (select * from scored where score is not null) S
-            join triples T0 on S.hash = T0.o
+            from ({matches}) S
+            join {osp_table} T0 on S.hash = T0.o
             {joins}
             where 1=1{prop_filter}{extra_g}
         )"""
-        return psql
+        return psql, params
 
     elif p[0] == "<":
-        joins = join_parents_sql(parents)
+        joins = join_parents_sql(parents, osp_table)
+        params[f"{name}_p"] = term_hash(p_without_hop)
 
         if o:
-            return f"(select distinct T{parents}.s from triples T0 {joins} where T0.p = '0x{pp}'::ubigint and T0.o{oo} {extra_g})"
+            return (
+                f"(select distinct T{parents}.s from {pos_table} T0 {joins} where T0.p = ${name}_p::ubigint and T0.o{oo} {extra_g})",
+                params,
+            )
         else:
-            return f"(select distinct T{parents}.s from triples T0 {joins} where T0.p = '0x{pp}'::ubigint {extra_g})"
+            del params[f"{name}_o"]
+            return (
+                f"(select distinct T{parents}.s from {pos_table} T0 {joins} where T0.p = ${name}_p::ubigint {extra_g})",
+                params,
+            )
 
 
 RDFS_LABEL_IRI = "<http://www.w3.org/2000/01/rdf-schema#label>"
 
 
-def _iri_hex(iri: str) -> str:
-    """Return SQL ubigint literal for a given IRI using the same xxhash64 scheme."""
-    h = xxhash.xxh64_hexdigest(iri).lower()
-    return f"'0x{h}'::ubigint"
-
-
 def _normalize_order_rules(order_rules):
     """Accept dict | [dict] | [[dict]] and return a flat [dict] list."""
     if not order_rules:
@@ -242,15 +739,17 @@ def _normalize_order_rules(order_rules):
     return order_rules
 
 
-def _lang_case_sql(val_expr: str, langs: list[str]) -> str:
+def _lang_case_sql(val_expr: str, langs: list[str], params: dict) -> str:
     """
     Build a CASE expression to rank labels by language preference.
     val_expr should be a column like L.value (e.g. '"Text"@de').
+    The language patterns are added to params.
     """
     parts = []
     rank = 1
     for lg in langs or []:
-        parts.append(f"WHEN {val_expr} LIKE '%\"@{lg}' THEN {rank}")
+        params[f"lang_{rank}"] = f'%"@{lg}'
+        parts.append(f"WHEN {val_expr} LIKE $lang_{rank} THEN {rank}")
         rank += 1
     parts.append(f"WHEN {val_expr} NOT LIKE '%\"@%' THEN {rank}")
     rank += 1
@@ -313,9 +812,10 @@ ORDER BY
 """
 
 
-def _order_build_sorted_table(db_cursor, order_rules: list):
+def _order_sorted_sql(order_rules: list, params: dict):
     """
-    Create temp table s_sorted(s, sort_label) sorted per the first rule.
+    Return the select of s_sorted(s, sort_label, pos) from s_results, pos numbering the
+    subjects per the first rule. The values it needs are added to params.
     Supported:
       {"by":"label","lang":["de","en"],"dir":"asc","nulls":"last",
        "mode":"lex"|"raw","natural":true|false,
@@ -323,9 +823,6 @@ def _order_build_sorted_table(db_cursor, order_rules: list):
       {"by":"property","prop":"<IRI>", ...}
       {"by":"object_label","via":"<IRI>", ...}
     """
-    if not order_rules:
-        return
-
     rule = order_rules[0]
     by = (rule.get("by") or "label").lower()
     langs = rule.get("lang") or ["de", "en"]
@@ -342,7 +839,7 @@ def _order_build_sorted_table(db_cursor, order_rules: list):
         "sort_label IS NULL DESC" if nulls == "first" else "sort_label IS NULL ASC"
     )
 
-    case_expr = _lang_case_sql("L.value", langs)
+    case_expr = _lang_case_sql("L.value", langs, params)
     raw_text = "regexp_extract(L.value, '^\"(.+)\"', 1)"
     sort_expr = _build_clean_expr(raw_text, clean, mode)
 
@@ -355,31 +852,27 @@ def _order_build_sorted_table(db_cursor, order_rules: list):
            TRY_CAST(NULLIF(regexp_extract(sort_label, '^(\\d+)', 1), '') AS INTEGER) AS num_prefix
     FROM pref
 )
-SELECT S.s, N.sort_label
+SELECT S.s, N.sort_label, row_number() OVER ({_natural_order_block('N', dir_sql)}) AS pos
 FROM s_results S
 LEFT JOIN numbered N ON N.s = S.s
-{_natural_order_block('N', dir_sql)}
 """
     else:
         post_block = f"""
-SELECT S.s, P.sort_label
+SELECT S.s, P.sort_label, row_number() OVER ({_plain_order_block(dir_sql, nulls_sql)}) AS pos
 FROM s_results S
 LEFT JOIN pref P ON P.s = S.s
-{_plain_order_block(dir_sql, nulls_sql)}
 """
 
     if by == "label":
-        prop_sql = _iri_hex(RDFS_LABEL_IRI)
-        db_cursor.execute(
-            f"""
-            create temp table s_sorted as
+        params["order_p"] = term_hash(RDFS_LABEL_IRI)
+        SQL = f"""
             with labels as (
                 select S.s,
                        L.value as lbl_val,
                        {case_expr} as lang_rank,
                        {sort_expr} as sort_label
                 from s_results S
-                join triples T on T.s = S.s and T.p = {prop_sql}
+                join triples T on T.s = S.s and T.p = $order_p::ubigint
                 join literals L on L.hash = T.o
             ),
             pref as (
@@ -393,23 +886,21 @@ LEFT JOIN pref P ON P.s = S.s
             )
             {post_block}
         """
-        )
+        return SQL
 
     elif by == "property":
         prop_iri = rule.get("prop")
         if not prop_iri:
             raise ValueError("order.by='property' requires 'prop' (IRI).")
-        prop_sql = _iri_hex(prop_iri)
-        db_cursor.execute(
-            f"""
-            create temp table s_sorted as
+        params["order_p"] = term_hash(prop_iri)
+        SQL = f"""
             with labels as (
                 select S.s,
                        L.value as lbl_val,
                        {case_expr} as lang_rank,
                        {sort_expr} as sort_label
                 from s_results S
-                join triples T on T.s = S.s and T.p = {prop_sql}
+                join triples T on T.s = S.s and T.p = $order_p::ubigint
                 join literals L on L.hash = T.o
             ),
             pref as (
@@ -423,21 +914,19 @@ LEFT JOIN pref P ON P.s = S.s
             )
             {post_block}
         """
-        )
+        return SQL
 
     elif by == "object_label":
         via_iri = rule.get("via")
         if not via_iri:
             raise ValueError("order.by='object_label' requires 'via' (IRI).")
-        via_sql = _iri_hex(via_iri)
-        rdfs_sql = _iri_hex(RDFS_LABEL_IRI)
-        db_cursor.execute(
-            f"""
-            create temp table s_sorted as
+        params["order_via"] = term_hash(via_iri)
+        params["order_p"] = term_hash(RDFS_LABEL_IRI)
+        SQL = f"""
             with objs as (
                 select S.s, T1.o as obj
                 from s_results S
-                join triples T1 on T1.s = S.s and T1.p = {via_sql}
+                join triples T1 on T1.s = S.s and T1.p = $order_via::ubigint
             ),
             olabels as (
                 select O.s,
@@ -445,7 +934,7 @@ LEFT JOIN pref P ON P.s = S.s
                        {case_expr} as lang_rank,
                        {sort_expr} as sort_label
                 from objs O
-                join triples T2 on T2.s = O.obj and T2.p = {rdfs_sql}
+                join triples T2 on T2.s = O.obj and T2.p = $order_p::ubigint
                 join literals L on L.hash = T2.o
             ),
             pref as (
@@ -459,13 +948,17 @@ LEFT JOIN pref P ON P.s = S.s
             )
             {post_block}
         """
-        )
+        return SQL
 
     else:
         raise ValueError(f"Unsupported order.by='{by}'")
 
 
 def handle_delete(opts: dict):
+    if BIKIDATA_PARQUET_PATH:
+        err = "The Parquet files in BIKIDATA_PARQUET_PATH are read-only"
+        log.error(err)
+        return {"error": err}
     buf = []
     buf_no_o = []
     for item in opts.get("data", []):
@@ -499,13 +992,36 @@ def handle_delete(opts: dict):
     result = {
         "triples_deleted": len(buf) + len(buf_no_o),
     }
-    DB = duckdb.connect(DB_PATH)
+    # DB_PATH can only be opened for writing once the shared read-only connection is closed
+    POOL.close()
+    try:
+        DB = duckdb.connect(DB_PATH)
+    except duckdb.IOException as e:
+        err = f"Can not open {DB_PATH} for writing, another process has it open: {e}"
+        log.error(err)
+        return {"error": err}
+    if dense_ids(DB):
+        # Terms without an id can not be in any triple
+        ids = term_ids(DB, [key for row in buf + buf_no_o for key in row])
+        buf = [
+            tuple(ids[key] for key in row)
+            for row in buf
+            if all(key in ids for key in row)
+        ]
+        buf_no_o = [
+            tuple(ids[key] for key in row)
+            for row in buf_no_o
+            if all(key in ids for key in row)
+        ]
+    # The clustered copies of the triples have to stay in step with the table
+    tables = {triple_tables(DB)[lookup] for lookup in TRIPLES_ONLY}
     if len(buf) > 0:
         try:
-            DB.executemany(
-                "DELETE FROM triples WHERE s = ?::ubigint and p = ?::ubigint and o = ?::ubigint and g = ?::ubigint",
-                buf,
-            )
+            for table in tables:
+                DB.executemany(
+                    f"DELETE FROM {table} WHERE s = ?::ubigint and p = ?::ubigint and o = ?::ubigint and g = ?::ubigint",
+                    buf,
+                )
             DB.commit()
         except Exception as e:
             log.error(f"Error during delete: {e}")
@@ -513,10 +1029,11 @@ def handle_delete(opts: dict):
 
     if len(buf_no_o) > 0:
         try:
-            DB.executemany(
-                "DELETE FROM triples WHERE s = ?::ubigint and p = ?::ubigint and g = ?::ubigint",
-                buf_no_o,
-            )
+            for table in tables:
+                DB.executemany(
+                    f"DELETE FROM {table} WHERE s = ?::ubigint and p = ?::ubigint and g = ?::ubigint",
+                    buf_no_o,
+                )
             DB.commit()
         except Exception as e:
             log.error(f"Error during delete: {e}")
@@ -527,6 +1044,10 @@ def handle_delete(opts: dict):
 
 
 def handle_insert(opts: dict):
+    if BIKIDATA_PARQUET_PATH:
+        err = "The Parquet files in BIKIDATA_PARQUET_PATH are read-only"
+        log.error(err)
+        return {"error": err}
     iris_to_add = {}
     literals_to_add = {}
     buf = []
@@ -567,10 +1088,27 @@ def handle_insert(opts: dict):
             iris_to_add[g] = gg
         buf.append((f"0x{ss}", f"0x{pp}", f"0x{oo}", f"0x{gg}"))
 
-    DB = duckdb.connect(DB_PATH)
+    # DB_PATH can only be opened for writing once the shared read-only connection is closed
+    POOL.close()
+    try:
+        DB = duckdb.connect(DB_PATH)
+    except duckdb.IOException as e:
+        err = f"Can not open {DB_PATH} for writing, another process has it open: {e}"
+        log.error(err)
+        return {"error": err}
+
+    if dense_ids(DB):
+        # New terms get the next free ids
+        ids = term_ids(DB, [key for row in buf for key in row], add=True)
+        buf = [tuple(ids[key] for key in row) for row in buf]
+    else:
+        ids = None
+
+    def stored_key(h: str):
+        return ids[f"0x{h}"] if ids is not None else f"0x{h}"
 
     result = {}
-    iri_checks = [("?::ubigint", f"0x{iri}") for iri in iris_to_add.values()]
+    iri_checks = [("?::ubigint", stored_key(iri)) for iri in iris_to_add.values()]
     existing = [
         row[0]
         for row in DB.execute(
@@ -578,12 +1116,14 @@ def handle_insert(opts: dict):
             [i for _, i in iri_checks],
         ).fetchall()
     ]
-    to_add = [(f"0x{h}", iri) for iri, h in iris_to_add.items() if iri not in existing]
+    to_add = [(stored_key(h), iri) for iri, h in iris_to_add.items() if iri not in existing]
     if len(to_add) > 0:
         DB.executemany("INSERT INTO iris (hash, value) VALUES (?::ubigint, ?)", to_add)
         result["iris_inserted"] = len(to_add)
 
-    literal_checks = [("?::ubigint", f"0x{lit}") for lit in literals_to_add.values()]
+    literal_checks = [
+        ("?::ubigint", stored_key(lit)) for lit in literals_to_add.values()
+    ]
     existing = [
         row[0]
         for row in DB.execute(
@@ -592,7 +1132,7 @@ def handle_insert(opts: dict):
         ).fetchall()
     ]
     to_add = [
-        (f"0x{h}", iri) for iri, h in literals_to_add.items() if iri not in existing
+        (stored_key(h), iri) for iri, h in literals_to_add.items() if iri not in existing
     ]
 
     try:
@@ -601,12 +1141,18 @@ def handle_insert(opts: dict):
                 "INSERT INTO literals (hash, value) VALUES (?::ubigint, ?)", to_add
             )
             result["literals_inserted"] = len(to_add)
+            if "trigrams" in triple_tables(DB):
+                DB.executemany(
+                    "INSERT INTO literals_trigrams (trigram, hash) SELECT unnest(literal_trigrams(?)), ?::ubigint",
+                    [(value, key) for key, value in to_add],
+                )
 
         if len(buf) > 0:
-            DB.executemany(
-                "INSERT INTO triples (s, p, o, g) VALUES (?::ubigint, ?::ubigint, ?::ubigint, ?::ubigint)",
-                buf,
-            )
+            for table in {triple_tables(DB)[lookup] for lookup in TRIPLES_ONLY}:
+                DB.executemany(
+                    f"INSERT INTO {table} (s, p, o, g) VALUES (?::ubigint, ?::ubigint, ?::ubigint, ?::ubigint)",
+                    buf,
+                )
             result["triples_inserted"] = len(buf)
         DB.commit()
     except Exception as e:
@@ -617,192 +1163,343 @@ def handle_insert(opts: dict):
     return result
 
 
-def query(opts):
-    try:
-        size = int(opts.get("size", 999))
-    except:
-        size = 999
-    try:
-        start = int(opts.get("start", 0))
-    except:
-        start = 0
+def results_steps(opts: dict, tables: dict, params: dict):
+    """
+    The steps that select the results of the filters in opts, as (name, select) in the
+    order they depend on each other, and the kind of order of the results: "s", "score"
+    for fts and semantic ranking or "pos" for the order rules. Each filter binds its own
+    $f<idx>_... parameters in params. The steps are empty when there are no filters.
+    """
     queries = []
     queries_except = []
     # due to the way set semantic works in SQL, the EXCEPT queries should be last in the list
     # but we can not control how users specify them, they might be added first
     fts_for_sorting = []
 
-    exclude_properties = opts.get("exclude_properties", [])
-    only_properties = opts.get("only_properties", [])
-
     # --- ADDED: sort-api (order parse & normalize) ---
     order_rules = _normalize_order_rules(opts.get("order", []))
     # --- END ADDED: sort-api ---
 
-    for query in opts.get("filters", []):
+    fts_params = {}
+    for idx, query in enumerate(opts.get("filters", [])):
+        if opts.get("_fts_limit"):
+            query = dict(query, _fts_limit=opts["_fts_limit"])
         op = query.get("op", "should")
         if str(query.get("p")).startswith("fts") or str(query.get("p")).startswith(
             "semantic"
         ):
             fts_query = query.copy()
             fts_query["_extra_fts_fields"] = ", score "
+            fts_sql, fts_query_params = q_to_sql(fts_query, tables, f"f{idx}")
             if not fts_for_sorting:
-                fts_for_sorting = [q_to_sql(fts_query)]
-            else:
-                if op in ("should", "or"):
-                    fts_for_sorting.append(" UNION " + q_to_sql(fts_query))
-                elif op in ("must", "and"):
-                    fts_for_sorting.append(" INTERSECT " + q_to_sql(fts_query))
+                fts_for_sorting = [fts_sql]
+                fts_params.update(fts_query_params)
+            elif op in ("should", "or"):
+                fts_for_sorting.append(" UNION " + fts_sql)
+                fts_params.update(fts_query_params)
+            elif op in ("must", "and"):
+                fts_for_sorting.append(" INTERSECT " + fts_sql)
+                fts_params.update(fts_query_params)
+        theq = q_to_sql(query, tables, f"f{idx}")
+        if not theq:
+            continue
+        theq, query_params = theq
         if not queries:
-            queries = [q_to_sql(query)]
+            queries = [theq]
+        elif op in ("should", "or"):
+            queries.append(" UNION " + theq)
+        elif op in ("must", "and"):
+            queries.append(" INTERSECT " + theq)
+        elif op == "not":
+            queries_except.append(" EXCEPT " + theq)
         else:
-            theq = q_to_sql(query)
-            if not theq:
-                continue
-            if op in ("should", "or"):
-                queries.append(" UNION " + theq)
-            elif op in ("must", "and"):
-                queries.append(" INTERSECT " + theq)
-            elif op == "not":
-                queries_except.append(" EXCEPT " + theq)
+            continue
+        params.update(query_params)
     queries.extend(queries_except)
-    queries = list(filter(None, queries))
-
-    DB = duckdb.connect(DB_PATH, read_only=True)
-    db_cursor = DB.cursor()
-    total = 0
-    tofetch = set()
-    results = {}
-    aggregates = {}
 
-    if len(queries) > 0:
-
-        if len(fts_for_sorting) > 0:
-            fts_queries_joined = (
-                "create temp table s_by_score as select s, max(score) as score from ("
+    steps = []
+    if not queries:
+        return steps, "s"
+    if len(fts_for_sorting) > 0:
+        params.update(fts_params)
+        steps.append(
+            (
+                "s_by_score",
+                "select s, max(score) as score from ("
                 + "\n".join(fts_for_sorting)
-                + ") group by s"
-            )
-            db_cursor.execute(fts_queries_joined)
-            # --- CHANGED: sort-api (remove early ORDER BY; we sort later) ---
-            queries_joined = (
-                "create temp table s_results as select distinct QJ.s from ("
-                + "\n".join(queries)
-                + ") QJ left join s_by_score SS on QJ.s = SS.s"
-            )
-            # --- END CHANGED: sort-api ---
-        else:
-            # --- CHANGED: sort-api (remove early ORDER BY; we sort later) ---
-            queries_joined = (
-                "create temp table s_results as select distinct s from ("
-                + "\n".join(queries)
-                + ")"
+                + ") group by s",
             )
-            # --- END CHANGED: sort-api ---
+        )
+    steps.append(("s_results", "select distinct s from (" + "\n".join(queries) + ")"))
+    if order_rules:
+        steps.append(("s_sorted", _order_sorted_sql(order_rules, params)))
+        return steps, "pos"
+    if len(fts_for_sorting) > 0:
+        return steps, "score"
+    return steps, "s"
+
+
+def properties_sql(opts: dict, params: dict):
+    "The condition on T.p for the only_properties or exclude_properties in opts"
+    if len(opts.get("only_properties", [])) > 0:
+        return f"and T.p in (select hash from iris where value in ({value_list('prop', opts['only_properties'], params)}))"
+    if len(opts.get("exclude_properties", [])) > 0:
+        return f"and T.p not in (select hash from iris where value in ({value_list('prop', opts['exclude_properties'], params)}))"
+    return ""
+
+
+def ordered_sql(kind: str):
+    "The select of all the results as (s, pos), numbered in the order of kind, see results_steps()"
+    if kind == "pos":
+        return "select s, pos from s_sorted"
+    if kind == "score":
+        return "select QJ.s, row_number() over (order by SS.score desc nulls last, QJ.s) as pos from s_results QJ left join s_by_score SS on QJ.s = SS.s"
+    return "select s, row_number() over (order by s) as pos from s_results"
+
+
+def results_triples_sql(opts: dict, tables: dict, params: dict):
+    """
+    The statement of the triples of all the results of the query in opts, as
+    (pos, s, p, o) with the values of the terms. Order by pos to get the results in the
+    order of query(), with the triples of each subject together. None without filters.
+    """
+    steps, kind = results_steps(opts, tables, params)
+    if not steps:
+        return None
+    steps.append(("ordered", ordered_sql(kind)))
+    ctes = "with " + ",\n".join(f"{name} as ({select})" for name, select in steps)
+    return f"""{ctes}
+        select distinct W.pos, S.value as s, P.value as p, coalesce(OI.value, OL.value) as o
+        from ordered W
+        join triples T on T.s = W.s {properties_sql(opts, params)}
+        left join iris S on S.hash = T.s
+        left join iris P on P.hash = T.p
+        left join iris OI on OI.hash = T.o
+        left join literals OL on OL.hash = T.o"""
+
+
+# A search for the first results looks up FTS_TOP_K times as many literals as results,
+# then FTS_TOP_K_GROWTH times more each time that is not enough, FTS_TOP_K_ROUNDS times.
+# For up to 50 literals (dynamic_or_filter_threshold), DuckDB passes them as a list of
+# values to the scan of triples_osp, which then skips the row groups that do not hold them.
+FTS_TOP_K = 2
+FTS_TOP_K_GROWTH = 8
+FTS_TOP_K_ROUNDS = 3
+
+
+def is_top_k_search(opts: dict):
+    """
+    Is opts one search ranked by score, of which only the page is needed, without the
+    total, aggregates or paths. Its first results are then the subjects of the best literals.
+    """
+    filters = opts.get("filters", [])
+    return (
+        len(filters) == 1
+        and str(filters[0].get("p")).startswith("fts")
+        and filters[0].get("op", "should") != "not"
+        and opts.get("total", True) is False
+        and not opts.get("order")
+        and not opts.get("aggregates")
+        and not opts.get("paths")
+        and not opts.get("cursor")
+        and not opts.get("_fts_limit")
+    )
 
-        db_cursor.execute(queries_joined)
 
-        # --- ADDED: sort-api (total & wanted page in SQL) ---
-        total = db_cursor.execute("select count(*) from s_results").fetchone()[0]
+def query(opts):
+    with POOL.cursor() as db_cursor:
+        return run_query(db_cursor, opts)
 
-        if order_rules:
-            _order_build_sorted_table(db_cursor, order_rules)
-            db_cursor.execute(
-                f"""
-                create temp table wanted as
-                select s, row_number() over () as pos
-                from s_sorted
-                limit {size} offset {start}
-            """
-            )
+
+def query_iter(opts: dict, batch_size: int = 1000):
+    """
+    Yield the entities of all the results of the query in opts, as the values of
+    query(opts)["results"] and in the same order. The triples are streamed from one
+    statement, batch_size rows at a time, so memory use does not grow with the number
+    of results. The size, start, cursor, aggregates and paths in opts are not used.
+    The iterator holds a cursor of the POOL until it is exhausted or closed.
+    """
+    with POOL.cursor() as db_cursor:
+        params = {}
+        SQL = results_triples_sql(opts, triple_tables(db_cursor), params)
+        if SQL is None:
+            return
+        result = execute(
+            db_cursor, SQL + " order by pos", params, dense_ids(db_cursor)
+        )
+        fields = entity = last_pos = None
+        while rows := result.fetchmany(batch_size):
+            for pos, r_s, r_p, r_o in rows:
+                if pos != last_pos:
+                    if fields is not None:
+                        yield {**fields, "id": entity, "graph": []}
+                    fields, entity, last_pos = {}, r_s, pos
+                fields.setdefault(r_p, []).append(r_o)
+        if fields is not None:
+            yield {**fields, "id": entity, "graph": []}
+
+
+def run_query(db_cursor, opts):
+    try:
+        size = int(opts.get("size", 999))
+    except:
+        size = 999
+    try:
+        start = int(opts.get("start", 0))
+    except:
+        start = 0
+
+    tables = triple_tables(db_cursor)
+    if is_top_k_search(opts) and tables.get("fts"):
+        # The page is right when the best literals hold enough subjects, counted as the
+        # total. Otherwise look up more of them, as long as more literals match.
+        matches = fts_postings_sql("f0", tables["fts"], scored=False)
+        matching = execute(
+            db_cursor,
+            f"select count(*) from ({matches})",
+            {"f0_text": opts["filters"][0].get("o", "")},
+            False,
+        ).fetchone()[0]
+        limit = (start + size) * FTS_TOP_K
+        for _ in range(FTS_TOP_K_ROUNDS):
+            if limit >= matching:
+                break
+            back = run_query(db_cursor, dict(opts, total=True, _fts_limit=limit))
+            if back["total"] >= start + size:
+                back["total"] = None
+                return back
+            limit *= FTS_TOP_K_GROWTH
+
+    dense = dense_ids(db_cursor)
+
+    params = {}
+    steps, kind = results_steps(opts, tables, params)
+
+    total = 0
+    results_mapped = {}
+    next_cursor = None
+    aggregates = {}
+    requested = opts.get("aggregates", [])
+    paths = opts.get("paths", [])
+
+    if steps:
+        params["size"] = size
+        params["start"] = start
+        # With a cursor, the page starts after the last result of the previous page, by
+        # its sort key, instead of skipping start results
+        for_query = query_key(
+            opts.get("filters", []), _normalize_order_rules(opts.get("order", []))
+        )
+        seek = ""
+        if opts.get("cursor"):
+            key = decode_cursor(opts["cursor"], kind, for_query)
+            params["start"] = 0
+            params["after_s"] = key["s"]
+            if kind == "pos":
+                params["after_pos"] = key["pos"]
+                seek = "where pos > $after_pos"
+            elif kind == "score" and key["score"] is None:
+                seek = "where SS.score is null and QJ.s > $after_s::ubigint"
+            elif kind == "score":
+                params["after_score"] = key["score"]
+                seek = "where (SS.score < $after_score or SS.score is null or (SS.score = $after_score and QJ.s > $after_s::ubigint))"
+            else:
+                seek = "where s > $after_s::ubigint"
+        if kind == "pos":
+            wanted = f"select s, pos, null as score from s_sorted {seek} order by pos limit $size offset $start"
+        elif kind == "score":
+            wanted = f"""select s, row_number() over (order by score desc nulls last, s) as pos, score from (
+                select QJ.s, SS.score from s_results QJ left join s_by_score SS on QJ.s = SS.s {seek}
+                order by SS.score desc nulls last, QJ.s limit $size offset $start)"""
         else:
-            if len(fts_for_sorting) > 0:
-                db_cursor.execute(
-                    f"""
-                    create temp table wanted as
-                    select QJ.s,
-                           row_number() over () as pos
-                    from s_results QJ
-                    left join s_by_score SS on QJ.s = SS.s
-                    order by SS.score desc, QJ.s
-                    limit {size} offset {start}
-                """
-                )
+            wanted = f"""select s, row_number() over (order by s) as pos, null as score from (
+                select s from s_results {seek} order by s limit $size offset $start)"""
+        steps.append(("wanted", wanted))
+
+        # The aggregates and paths need the results in several statements, then they are
+        # kept in temp tables. Otherwise all the steps are CTEs of the statement that
+        # fetches the page, which only reads the rows of the page.
+        with_total = opts.get("total", True)
+        if requested or paths:
+            for name, select in steps:
+                execute(db_cursor, f"create temp table {name} as {select}", params, dense)
+            ctes = ""
+            total = db_cursor.execute("select count(*) from s_results").fetchone()[0]
+        else:
+            ctes = "with " + ",\n".join(
+                f"{name} as {'materialized ' if name == 's_results' and with_total else ''}({select})"
+                for name, select in steps
+            )
+            total = None
+
+        props = properties_sql(opts, params)
+        count = "(select count(*) from s_results)" if total is None and with_total else "null"
+        # fetch triples for the current page in deterministic order (by wanted.pos)
+        # The left join keeps a row for the subjects that have no triples left after
+        # the props filter, so that the last one on the page is known for the cursor
+        page = execute(
+            db_cursor,
+            f"""{ctes}
+            select distinct W.pos, W.s, T.p, T.o, W.score, {count} as total
+            from wanted W
+            left join triples T on T.s = W.s {props}
+            order by W.pos""",
+            params,
+            dense,
+        ).fetchnumpy()
+        if total is None and with_total:
+            if len(page["s"]):
+                total = int(page["total"][0])
             else:
-                db_cursor.execute(
-                    f"""
-                    create temp table wanted as
-                    select s, row_number() over () as pos
-                    from s_results
-                    order by s
-                    limit {size} offset {start}
-                """
-                )
-        # --- END ADDED: sort-api ---
+                total = execute(
+                    db_cursor, f"{ctes} select count(*) from s_results", params, dense
+                ).fetchone()[0]
+
+        if len(np.unique(page["pos"])) == size and size > 0:
+            last = {"k": kind, "q": for_query, "s": int(page["s"][-1])}
+            if kind == "pos":
+                last["pos"] = int(page["pos"][-1])
+            elif kind == "score":
+                score = page["score"][-1]
+                last["score"] = None if np.ma.is_masked(score) else float(score)
+            next_cursor = encode_cursor(last)
+
+        found = ~np.ma.getmaskarray(page["p"])
+        s_col, p_col, o_col = (
+            np.ma.getdata(page[column])[found] for column in ("s", "p", "o")
+        )
+        HV = term_values(db_cursor, np.concatenate([s_col, p_col, o_col]))
+        s_values = HV.lookup(s_col).tolist()
+        p_values = HV.lookup(p_col).tolist()
+        o_values = HV.lookup(o_col).tolist()
+        # The page is ordered by pos, so the rows of each subject are consecutive
+        fields = None
+        last_s = None
+        for r_s, r_p, r_o in zip(s_values, p_values, o_values):
+            if fields is None or r_s != last_s:
+                fields = results_mapped.setdefault(r_s, {})
+                last_s = r_s
+            fields.setdefault(r_p, []).append(r_o)
+        for entity, fields in results_mapped.items():
+            fields["id"] = entity
+            fields["graph"] = []
 
         # check for aggregates (computed on full s_results set)
-        for agg in opts.get("aggregates", []):
+        for agg in requested:
             if agg == "graphs":
                 tmp = f"select distinct count(g) as count, I.value as val from s_results S join triples T on S.s = T.s join iris I on T.g = I.hash group by T.g, I.value"
             elif agg == "properties":
                 tmp = f"select count(p) as count, I.value as val from s_results S join triples T on S.s = T.s join iris I on T.p = I.hash group by p, I.value"
             else:
-                agg_o = xxhash.xxh64_hexdigest(str(agg)).lower()
-                tmp = f"(select distinct count(T.s) as count, I.value as val from s_results S join triples T on S.s = T.s join iris I on T.o = I.hash where T.p = '0x{agg_o}'::ubigint group by o, I.value) union (select distinct count(T.s) as count, L.value as val from s_results S join triples T on S.s = T.s join literals L on T.o = L.hash where T.p = '0x{agg_o}'::ubigint group by T.o, L.value) order by count desc"
-            aggs = db_cursor.execute(tmp).df()
-            aggregates[agg] = aggs
-
-        # fetch triples for the current page in deterministic order (by wanted.pos)
-        if db_cursor.execute("select count(*) from wanted").fetchone()[0] > 0:
-            if len(only_properties) > 0:
-                only_properties_list = ",".join([f"'{op}'" for op in only_properties])
-                s_ids_q = f"""
-                    with only_props as (select hash from iris where value in ({only_properties_list}))
-                    select distinct T.s, T.p, T.o, T.g
-                    from wanted W
-                    join triples T on T.s = W.s
-                    where T.p in (select hash from only_props)
-                    order by W.pos
-                """
-            elif len(exclude_properties) > 0:
-                exclude_properties_list = ",".join(
-                    [f"'{ep}'" for ep in exclude_properties]
-                )
-                s_ids_q = f"""
-                    with excl_props as (select hash from iris where value in ({exclude_properties_list}))
-                    select distinct T.s, T.p, T.o, T.g
-                    from wanted W
-                    join triples T on T.s = W.s
-                    where T.p not in (select hash from excl_props)
-                    order by W.pos
-                """
-            else:
-                s_ids_q = """
-                    select distinct T.s, T.p, T.o, T.g
-                    from wanted W
-                    join triples T on T.s = W.s
-                    order by W.pos
-                """
-            triples = db_cursor.execute(s_ids_q).df()
-
-            for _, row in triples.iterrows():
-                r_s = row.get("s")
-                r_p = row.get("p")
-                r_o = row.get("o")
-                r_g = row.get("g")
-                tofetch.add(r_s)
-                tofetch.add(r_p)
-                tofetch.add(r_o)
-                if r_g is False:
-                    tofetch.add(r_g)
-                    results.setdefault(r_s, {}).setdefault("graph", set()).add(r_g)
-                results.setdefault(r_s, {}).setdefault(r_p, set()).add(r_o)
-
-            # Fetch the paths (restricted to current page subjects)
-            for pad in opts.get("paths", []):
-                padd = xxhash.xxh64_hexdigest(str(pad)).lower()
-                padsql = f"""with recursive parents(s, parent) as 
- (select distinct s , parent from triples left join (select s as part, o as parent from triples where p = '0x{padd}'::ubigint) on s = part),
+                params["agg_p"] = term_hash(str(agg))
+                tmp = "(select distinct count(T.s) as count, I.value as val from s_results S join triples T on S.s = T.s join iris I on T.o = I.hash where T.p = $agg_p::ubigint group by o, I.value) union (select distinct count(T.s) as count, L.value as val from s_results S join triples T on S.s = T.s join literals L on T.o = L.hash where T.p = $agg_p::ubigint group by T.o, L.value) order by count desc"
+            aggregates[agg] = execute(db_cursor, tmp, params, dense).fetchall()
+
+        # Fetch the paths (restricted to current page subjects)
+        for pad in paths:
+            params["path_p"] = term_hash(str(pad))
+            padsql = """with recursive parents(s, parent) as 
+ (select distinct s , parent from triples left join (select s as part, o as parent from triples where p = $path_p::ubigint) on s = part),
 hier(source, path) as (
     select s, [s]::ubigint[] as path
     from parents
@@ -812,75 +1509,36 @@ hier(source, path) as (
     from parents, hier
     where parent = hier.source
 )
-select source, path from hier where source in (select s from wanted)
+select H.source, list(I.value order by N.idx) filter (where N.node != H.source)
+from hier H, unnest(H.path) with ordinality as N(node, idx)
+left join iris I on I.hash = N.node
+where H.source in (select s from wanted)
+group by H.source, H.path
 """
-                for _, row in db_cursor.execute(padsql).df().iterrows():
-                    padr_s = row.get("source")
-                    results.setdefault(padr_s, {}).setdefault("_paths", {})
-                    results[padr_s]["_paths"][pad] = list(row.get("path"))
-                    for x in row.get("path"):
-                        tofetch.add(x)
+            for source, path in execute(db_cursor, padsql, params, dense).fetchall():
+                # fetching the paths recursively can cause entities to be returned with only the path field, which is not a valid result entity. Skip them
+                fields = results_mapped.get(HV.get(source))
+                if fields is not None:
+                    fields.setdefault("_paths", {})[pad] = path or []
 
     # Special aggregates
-    if "properties" in opts.get("aggregates", []) and len(queries) < 1:
+    if "properties" in requested and not steps:
         aggregates["properties"] = db_cursor.execute(
             "select count(p) as count, I.value as val from triples T join iris I on T.p = I.hash group by p, I.value"
-        ).df()
-    if "graphs" in opts.get("aggregates", []) and len(queries) < 1:
+        ).fetchall()
+    if "graphs" in requested and not steps:
         aggregates["graphs"] = db_cursor.execute(
             "select count(g) as count, I.value as val from triples T join iris I on T.g = I.hash group by g, I.value"
-        ).df()
-
-    if len(tofetch) > 0:
-        tofetch = ", ".join([str(x) for x in tofetch])
-
-        HV = dict(
-            [
-                (hash, value)
-                for hash, value in db_cursor.execute(
-                    f"(select hash, value from iris where hash in ({tofetch})) union (select hash, value from literals where hash in ({tofetch}))"
-                ).fetchall()
-            ]
-        )
-        HV["graph"] = "graph"
+        ).fetchall()
 
-    results_mapped = {}
-    for entity, fields in results.items():
-        for field, vals in fields.items():
-            if field == "_paths":
-                continue
-            for val in vals:
-                results_mapped.setdefault(HV.get(entity), {}).setdefault(
-                    HV.get(field), []
-                ).append(HV.get(val))
-        mapped_entity = HV.get(entity)
-        if mapped_entity in results_mapped:
-            results_mapped[mapped_entity]["id"] = mapped_entity
-            ## fetching the paths recursively can cause entities to be returned with only the path field, which is not a valid result entity. Skip them
-            graph = results_mapped[mapped_entity].get("graph", [])
-            results_mapped[mapped_entity]["graph"] = list(graph)
-            if "_paths" in fields:
-                for path, vals in fields["_paths"].items():
-                    vals = [HV.get(val) for val in vals if val != entity]
-                    results_mapped[mapped_entity].setdefault("_paths", {})[path] = vals
-
-    # This is a security risk, we can not just accept a random filename
-    # Either remove it completely, or add some form of sanitization
-    # if "dump" in opts:
-    #     with open(opts["dump"], "w") as DUMPFILE:
-    #         for entity, fields in results_mapped.items():
-    #             for field, vals in fields.items():
-    #                 for val in vals:
-    #                     DUMPFILE.write(f"{entity} {field} {val} .\n")
-
-    aggregates_mapped = {}
-    for agg, aggs in aggregates.items():
-        aggregates_mapped[agg] = []
-        for _, row in aggs.iterrows():
-            aggregates_mapped[agg].append((row["count"], row["val"]))
-
-    back = {"results": results_mapped, "total": total, "size": size, "start": start}
+    back = {
+        "results": results_mapped,
+        "total": total,
+        "size": size,
+        "start": start,
+        "cursor": next_cursor,
+    }
     if aggregates:
-        back["aggregates"] = aggregates_mapped
+        back["aggregates"] = aggregates
 
     return back
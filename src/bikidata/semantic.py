@@ -1,47 +1,184 @@
-import os, time
+import os, re, time, threading, importlib
+from collections import OrderedDict
 import duckdb
-from .main import DB_PATH, log, build_ftss
-import cohere
+import numpy as np
+import xxhash
+from .main import DB_PATH, log, build_ftss, release_query_pool, temp_paths
+from .metrics import BuildMetrics
+from .ivf import index_semantic
 
 VEC_DIM = 1024
 
-COHERE_API_KEY = os.environ.get("COHERE_API_KEY")
-if not COHERE_API_KEY:
-    log.error("COHERE_API_KEY environment variable is not set. ")
-else:
-    co = cohere.ClientV2(COHERE_API_KEY)
+# What turns texts into vectors: "cohere", "hash" for local vectors without a model, or
+# "package.module:factory" for a function that returns an embedder, see set_embedder()
+BIKIDATA_EMBEDDER = os.getenv("BIKIDATA_EMBEDDER", "cohere")
+# The vectors of query texts are kept in memory, the most recently used this many, and in
+# this DuckDB file, shared by the processes. Set it to "" to only keep them in memory.
+BIKIDATA_EMBEDDING_CACHE_SIZE = int(os.getenv("BIKIDATA_EMBEDDING_CACHE_SIZE", 1024))
+BIKIDATA_EMBEDDING_CACHE = os.getenv("BIKIDATA_EMBEDDING_CACHE", DB_PATH + ".embeddings")
+
+# An embedder has a model name, a dimension, and embed(texts, input_type) that returns a
+# vector for each of the texts. input_type is "search_query" or "search_document".
+
+
+class CohereEmbedder:
+    """
+    Vectors from Cohere's embed-v4.0. The cohere package is imported, and the client made
+    with COHERE_API_KEY, when the first texts are embedded.
+    """
+
+    model = "embed-v4.0"
+
+    def __init__(self, dimension: int = VEC_DIM):
+        self.dimension = dimension
+        self.client = None
+
+    def embed(self, texts: list, input_type: str) -> list:
+        if self.client is None:
+            if not os.environ.get("COHERE_API_KEY"):
+                raise RuntimeError("COHERE_API_KEY environment variable is not set")
+            import cohere
+
+            self.client = cohere.ClientV2(os.environ["COHERE_API_KEY"])
+        return self.client.embed(
+            model=self.model,
+            input_type=input_type,
+            texts=texts,
+            max_tokens=8000,
+            truncate="END",
+            output_dimension=self.dimension,
+            embedding_types=["float"],
+        ).embeddings.float
+
+
+class HashEmbedder:
+    """
+    Vectors without a model, for tests and offline use: each lowercased word of a text adds
+    1 or -1 to a dimension, both picked by its xxhash. Texts that share words are near, and
+    a text gets the same vector everywhere.
+    """
+
+    model = "hash"
+
+    def __init__(self, dimension: int = VEC_DIM):
+        self.dimension = dimension
+
+    def embed(self, texts: list, input_type: str) -> list:
+        vectors = []
+        for text in texts:
+            vector = np.zeros(self.dimension, dtype=np.float32)
+            for word in re.findall(r"\w+", text.lower()):
+                word_hash = xxhash.xxh64_intdigest(word)
+                vector[word_hash % self.dimension] += 1 if word_hash >> 63 else -1
+            vectors.append(vector.tolist())
+        return vectors
+
+
+EMBEDDERS = {"cohere": CohereEmbedder, "hash": HashEmbedder}
+EMBEDDER_LOCK = threading.Lock()
+CURRENT = {"embedder": None}
+
+
+def set_embedder(new_embedder):
+    "Embed the texts of semantic filters and of build_semantic() with new_embedder from now on"
+    with EMBEDDER_LOCK:
+        CURRENT["embedder"] = new_embedder
+
+
+def embedder():
+    "The embedder in use, made from BIKIDATA_EMBEDDER when it is first needed"
+    with EMBEDDER_LOCK:
+        if CURRENT["embedder"] is None:
+            if BIKIDATA_EMBEDDER in EMBEDDERS:
+                CURRENT["embedder"] = EMBEDDERS[BIKIDATA_EMBEDDER]()
+            else:
+                module, _, factory = BIKIDATA_EMBEDDER.partition(":")
+                CURRENT["embedder"] = getattr(importlib.import_module(module), factory)()
+        return CURRENT["embedder"]
+
+
+class EmbeddingCache:
+    "The size most recently used vectors, by (model, dimension, text)"
+
+    def __init__(self, size: int):
+        self.size = size
+        self.lock = threading.Lock()
+        self.vectors = OrderedDict()
+
+    def get(self, key: tuple):
+        with self.lock:
+            vector = self.vectors.get(key)
+            if vector is not None:
+                self.vectors.move_to_end(key)
+            return vector
+
+    def put(self, key: tuple, vector: list):
+        with self.lock:
+            self.vectors[key] = vector
+            self.vectors.move_to_end(key)
+            while len(self.vectors) > self.size:
+                self.vectors.popitem(last=False)
+
+
+CACHE = EmbeddingCache(BIKIDATA_EMBEDDING_CACHE_SIZE)
+
+
+def stored_embedding(key: tuple, vector: list | None = None):
+    """
+    The vector of key in the query_embeddings table of BIKIDATA_EMBEDDING_CACHE, or None,
+    or store vector for key there. The file is only open for a moment, and left alone
+    when another process has it open.
+    """
+    if not BIKIDATA_EMBEDDING_CACHE:
+        return None
+    try:
+        with duckdb.connect(BIKIDATA_EMBEDDING_CACHE) as db_connection:
+            db_connection.execute(
+                """create table if not exists query_embeddings (
+                    model varchar, dimension integer, text varchar, vec float[],
+                    primary key (model, dimension, text))"""
+            )
+            if vector is not None:
+                db_connection.execute(
+                    "insert or ignore into query_embeddings values (?, ?, ?, ?)",
+                    [*key, vector],
+                )
+                return vector
+            row = db_connection.execute(
+                "select vec from query_embeddings where model = ? and dimension = ? and text = ?",
+                list(key),
+            ).fetchone()
+            return row[0] if row else None
+    except duckdb.Error as e:
+        log.debug(f"Embedding cache {BIKIDATA_EMBEDDING_CACHE} not used: {e}")
+        return None
 
 
 def get_embedding(text: str) -> list:
-    doc_emb = co.embed(
-        model="embed-v4.0",
-        input_type="search_query",
-        texts=[text],
-        max_tokens=8000,
-        truncate="END",
-        output_dimension=VEC_DIM,
-        embedding_types=["float"],
-    ).embeddings.float
-    return doc_emb[0]
+    "The vector of a query text, from the cache, or embedded and then cached"
+    current = embedder()
+    key = (current.model, current.dimension, text)
+    vector = CACHE.get(key)
+    if vector is None:
+        vector = stored_embedding(key)
+        if vector is None:
+            vector = current.embed([text], "search_query")[0]
+            stored_embedding(key, vector)
+        CACHE.put(key, vector)
+    return vector
 
 
 def get_buf_embeddings(buf):
-    doc_emb = co.embed(
-        model="embed-v4.0",
-        input_type="search_document",
-        texts=[text for _, text in buf],
-        max_tokens=8000,
-        truncate="END",
-        output_dimension=VEC_DIM,
-        embedding_types=["float"],
-    ).embeddings.float
+    doc_emb = embedder().embed([text for _, text in buf], "search_document")
     return [(sid, vec) for (sid, _), vec in zip(buf, doc_emb)]
 
 
-def build_semantic(batch_size: int = 96) -> dict:
+def build_semantic(batch_size: int = 96, progress_callback=None) -> dict:
     # The max batch size in cohere is 96: https://docs.cohere.com/reference/embed
     start_time = time.time()
+    metrics = BuildMetrics(progress_callback, temp_paths())
 
+    release_query_pool()
     DB = duckdb.connect(DB_PATH)
     db_connection = DB.cursor()
 
@@ -53,35 +190,42 @@ def build_semantic(batch_size: int = 96) -> dict:
         literals = db_connection.execute("SELECT s, values FROM fts").fetchall()
 
     db_connection.execute(
-        f"CREATE TABLE IF NOT EXISTS literals_semantic (hash ubigint, vec FLOAT[{VEC_DIM}]);"
+        f"CREATE TABLE IF NOT EXISTS literals_semantic (hash ubigint, vec FLOAT[{embedder().dimension}]);"
     )
     buf = []
     log.debug(
         f"Starting semantic index build for {len(literals)} items with batch size of {batch_size}"
     )
     idx = 0
-    for sid, values in literals:
-        idx += 1
-        if not values:
-            continue
-        buf.append((sid, values))
-        if len(buf) >= batch_size:
-            progress = int((idx / len(literals)) * 100)
-            duration = time.time() - start_time
-            tps = int(idx / duration)
-            log.debug(f"Now inserting {len(buf)} literals, at {progress}% {tps} tps")
+    with metrics.phase("semantic") as semantic_metrics:
+        for sid, values in literals:
+            idx += 1
+            if not values:
+                continue
+            buf.append((sid, values))
+            if len(buf) >= batch_size:
+                progress = int((idx / len(literals)) * 100)
+                duration = time.time() - start_time
+                tps = int(idx / duration)
+                log.debug(f"Now inserting {len(buf)} literals, at {progress}% {tps} tps")
+                db_connection.executemany(
+                    "INSERT INTO literals_semantic (hash, vec) VALUES (?, ?)",
+                    get_buf_embeddings(buf),
+                )
+                semantic_metrics["rows"] += len(buf)
+                buf = []
+                metrics.emit("semantic", "progress", done=idx, total=len(literals))
+
+        if buf:
+            log.debug(f"Now inserting final {len(buf)}")
             db_connection.executemany(
                 "INSERT INTO literals_semantic (hash, vec) VALUES (?, ?)",
                 get_buf_embeddings(buf),
             )
-            buf = []
-
-    if buf:
-        log.debug(f"Now inserting final {len(buf)}")
-        db_connection.executemany(
-            "INSERT INTO literals_semantic (hash, vec) VALUES (?, ?)",
-            get_buf_embeddings(buf),
-        )
+            semantic_metrics["rows"] += len(buf)
     db_connection.commit()
+    index_semantic(db_connection, metrics)
     end_time = time.time()
-    return {"duration": int(end_time - start_time), "count": idx}
+    result = {"duration": int(end_time - start_time), "count": idx}
+    result.update(metrics.report())
+    return result
@@ -0,0 +1,251 @@
+import os, logging, json, glob, time
+from itertools import islice
+import duckdb
+import numpy as np
+import pandas as pd
+import xxhash
+
+log = logging.getLogger("bikidata")
+
+# Number of triples buffered in memory before a batch is spilled to a Parquet file
+BIKIDATA_STAGING_BATCH = int(os.getenv("BIKIDATA_STAGING_BATCH", 1_000_000))
+# Memory budget in MB, per staging process, for the set of term hashes already written
+BIKIDATA_DEDUP_MEMORY = int(os.getenv("BIKIDATA_DEDUP_MEMORY", 256))
+# Rough cost of one int in a Python set: the int object plus its share of the hash table
+SEEN_ENTRY_BYTES = 72
+
+CHECKPOINT_FILE = "checkpoint.json"
+STAGING_PATTERNS = ("triples-*.parquet", "terms-*.parquet", "task-*.json", CHECKPOINT_FILE)
+
+
+def H(v: str):
+    return xxhash.xxh64_intdigest(v)
+
+
+class StagingWriter:
+    """
+    Buffers the hashes of triples and their terms in columnar batches, and spills
+    each batch to a pair of Parquet files in the staging directory:
+      triples-<prefix>-<seq>.parquet (s, p, o, g as ubigint)
+      terms-<prefix>-<seq>.parquet   (hash as ubigint, value as varchar)
+
+    Terms are de-duplicated on the way in, so that a popular IRI like rdf:type is
+    staged roughly once instead of once per triple. The set of hashes already written
+    is exact, but bounded by dedup_memory (in MB). When the budget is used up the set
+    is cleared and starts filling again, the hot terms come back quickly. Duplicates
+    that slip through a reset, or that were written by other processes of a parallel
+    build, are removed by the group by in the final load, so the result stays exact.
+    A Bloom filter would be smaller, but a false positive would silently drop a term.
+
+    With auto_flush=False batches are only spilled by calling flush(), so that the
+    caller can line them up with a checkpoint. A resumed writer continues after the
+    triple_files, term_files and count of its previous run.
+    """
+
+    def __init__(
+        self,
+        staging_path: str,
+        prefix: str = "0",
+        batch_size: int = BIKIDATA_STAGING_BATCH,
+        dedup_memory: int = BIKIDATA_DEDUP_MEMORY,
+        auto_flush: bool = True,
+        triple_files: list | None = None,
+        term_files: list | None = None,
+        count: int = 0,
+    ):
+        self.staging_path = staging_path
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.auto_flush = auto_flush
+        self.triple_files = list(triple_files or [])
+        self.term_files = list(term_files or [])
+        self.count = count
+        self.seen = set()
+        self.max_seen = max(1, dedup_memory * 1024 * 1024 // SEEN_ENTRY_BYTES)
+        self.terms_written = 0
+        self.dedup_resets = 0
+        self.flush_seconds = 0.0
+        self.bytes_written = 0
+        self.con = duckdb.connect()
+        self.reset()
+        os.makedirs(staging_path, exist_ok=True)
+
+    def reset(self):
+        self.s = []
+        self.p = []
+        self.o = []
+        self.g = []
+        self.term_hashes = []
+        self.term_values = []
+
+    def add_term(self, hash: int, value: str):
+        if hash in self.seen:
+            return
+        if len(self.seen) >= self.max_seen:
+            self.seen.clear()
+            self.dedup_resets += 1
+        self.seen.add(hash)
+        self.term_hashes.append(hash)
+        self.term_values.append(value)
+
+    def add(self, s: str, p: str, o: str, g: str):
+        ss = H(s)
+        pp = H(p)
+        oo = H(o)
+        gg = H(g)
+        self.s.append(ss)
+        self.p.append(pp)
+        self.o.append(oo)
+        self.g.append(gg)
+        self.add_term(ss, s)
+        self.add_term(pp, p)
+        self.add_term(oo, o)
+        # The default graph "" is not a term, it has no row in iris
+        if g:
+            self.add_term(gg, g)
+        self.count += 1
+        if self.auto_flush and self.full():
+            self.flush()
+
+    def full(self):
+        return len(self.s) >= self.batch_size
+
+    def flush(self):
+        if not self.s and not self.term_hashes:
+            return
+        start_time = time.time()
+        seq = len(self.triple_files)
+        triple_file = os.path.join(
+            self.staging_path, f"triples-{self.prefix}-{seq:05d}.parquet"
+        )
+        term_file = os.path.join(
+            self.staging_path, f"terms-{self.prefix}-{seq:05d}.parquet"
+        )
+        staged_triples = pd.DataFrame(
+            {
+                "s": np.array(self.s, dtype=np.uint64),
+                "p": np.array(self.p, dtype=np.uint64),
+                "o": np.array(self.o, dtype=np.uint64),
+                "g": np.array(self.g, dtype=np.uint64),
+            }
+        )
+        staged_terms = pd.DataFrame(
+            {
+                "hash": np.array(self.term_hashes, dtype=np.uint64),
+                "value": self.term_values,
+            }
+        )
+        self.con.register("staged_triples", staged_triples)
+        self.con.register("staged_terms", staged_terms)
+        self.con.execute(
+            f"copy staged_triples to '{triple_file}' (format parquet, compression zstd)"
+        )
+        self.con.execute(
+            f"copy staged_terms to '{term_file}' (format parquet, compression zstd)"
+        )
+        self.con.unregister("staged_triples")
+        self.con.unregister("staged_terms")
+        self.triple_files.append(triple_file)
+        self.term_files.append(term_file)
+        self.terms_written += len(self.term_hashes)
+        self.bytes_written += os.path.getsize(triple_file) + os.path.getsize(term_file)
+        self.reset()
+        self.flush_seconds += time.time() - start_time
+
+    def close(self):
+        self.flush()
+        self.con.close()
+        self.seen = set()
+        log.debug(
+            f"Staged {self.count} triples with {self.terms_written} terms, dedup set was reset {self.dedup_resets} times"
+        )
+
+
+def write_staging(iterator, writer: StagingWriter):
+    stage_triples(iterator, writer)
+    writer.close()
+    return writer.count
+
+
+# Triples are pulled from the parser in chunks of this size, to time parsing and hashing apart
+TIMING_CHUNK = 65536
+
+
+def stage_triples_timed(iterator, writer: StagingWriter, timings: dict):
+    """
+    Like stage_triples(), adding the seconds spent producing the triples (parsing)
+    and adding them to the writer (hashing) to timings["parse"] and timings["hash"].
+    Time spent spilling batches is kept by the writer in flush_seconds.
+    """
+    while True:
+        flushed_before = writer.flush_seconds
+        start_time = time.time()
+        chunk = list(islice(iterator, TIMING_CHUNK))
+        parsed_time = time.time()
+        # The parser may have triggered a flush of the previous chunks, that is not parsing
+        timings["parse"] += parsed_time - start_time - (writer.flush_seconds - flushed_before)
+        if not chunk:
+            break
+        stage_triples(chunk, writer)
+        timings["hash"] += time.time() - parsed_time
+
+
+def stage_triples(iterator, writer: StagingWriter):
+    for s, p, o, g in iterator:
+        try:
+            writer.add(s, p, o, g)
+        except UnicodeEncodeError as e:
+            log.error(f"Error hashing {e}")
+            continue
+            # Certain strings can casues errors, especially emojis encoded in JSON
+            # For example, "\ud83d\ude09" is how the smiley gets encoded in JSON (as a Javascript string)
+            # If you try to treat this as a UTF-8 string it throws an error.
+            # json.loads(r'"\ud83d\ude09"') <- this works
+            # "\ud83d\ude09".encode('utf8') <- this throws an error
+
+
+def read_json(path: str):
+    try:
+        with open(path) as F:
+            return json.load(F)
+    except FileNotFoundError:
+        return None
+
+
+def write_json(path: str, data):
+    "Write atomically, so that a crash leaves either the old or the new version"
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as F:
+        json.dump(data, F)
+        F.flush()
+        os.fsync(F.fileno())
+    os.replace(tmp_path, path)
+
+
+def input_fingerprint(triplefile_paths: list):
+    "Identify the inputs of a build, to check that a checkpoint belongs to them"
+    fingerprint = []
+    for triplefile_path in triplefile_paths:
+        stat = os.stat(triplefile_path)
+        fingerprint.append([str(triplefile_path), stat.st_size, int(stat.st_mtime)])
+    return fingerprint
+
+
+def load_checkpoint(staging_path: str):
+    return read_json(os.path.join(staging_path, CHECKPOINT_FILE))
+
+
+def save_checkpoint(staging_path: str, checkpoint: dict):
+    os.makedirs(staging_path, exist_ok=True)
+    write_json(os.path.join(staging_path, CHECKPOINT_FILE), checkpoint)
+
+
+def clear_staging(staging_path: str):
+    "Remove the files a build leaves in the staging directory, and the directory if it is then empty"
+    for pattern in STAGING_PATTERNS:
+        for staged_file in glob.glob(os.path.join(staging_path, pattern)):
+            os.unlink(staged_file)
+    try:
+        os.rmdir(staging_path)
+    except OSError:
+        pass  # not empty, leave anything we did not put there
@@ -3,6 +3,7 @@ import xxhash
 import duckdb
 from .query import query, handle_insert, handle_delete
 from .main import log
+from .pool import POOL, BIKIDATA_POOL_IDLE
 from multiprocessing import Process
 import asyncio
 
@@ -18,9 +19,14 @@ except:
 
 WORKER_FETCH_Q = "bikidata:queries"
 WORKER_FETCH_Q_READY = "bikidata:queries_ready"
+# The workers query DB_PATH while the manager writes to it from another process, so unless
+# BIKIDATA_POOL_IDLE says otherwise they close it this many seconds after their last query
+WORKER_POOL_IDLE = 1.0
 
 
 def worker_process_entry():
+    if BIKIDATA_POOL_IDLE is None:
+        POOL.idle = WORKER_POOL_IDLE
     asyncio.run(redis_worker())
 
 
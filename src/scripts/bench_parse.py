@@ -0,0 +1,92 @@
+"""
+Micro-benchmark of the N-Triples tokenizer in bikidata.ntriples against the
+line-by-line parser that read_nt() used before.
+
+    python bench_parse.py myfile.nt [repeats]
+
+Reports lines/sec for both, and checks that they yield the same triples.
+"""
+
+import sys, time, re
+from bikidata.ntriples import iter_line_batches, new_stats, tokenize_lines
+
+
+def legacy_decode_unicode_escapes(s):
+    unicode_escape_pattern_u = re.compile(r"\\u([0-9a-fA-F]{4})")
+    unicode_escape_pattern_U = re.compile(r"\\U([0-9a-fA-F]{8})")
+
+    def replace_unicode_escape(match):
+        return chr(int(match.group(1), 16))
+
+    s = unicode_escape_pattern_U.sub(replace_unicode_escape, s)
+    s = unicode_escape_pattern_u.sub(replace_unicode_escape, s)
+    return s
+
+
+def legacy_parse(thefile):
+    g = ""
+    for line in thefile:
+        if not line.endswith(b" .\n"):
+            if line.endswith(b" {\n") and line.startswith(b"<"):
+                parts = line.decode("utf8").split(" ")
+                if len(parts) == 2:
+                    g = parts[0]
+                    continue
+            else:
+                continue
+        line = legacy_decode_unicode_escapes(line.decode("utf8"))
+        line = line.strip()
+        line = line[:-2]
+        parts = line.split(" ")
+        if len(parts) > 2:
+            s = parts[0]
+            p = parts[1]
+            o = " ".join(parts[2:])
+        if not (s.startswith("<") and s.endswith(">")):
+            if not s.startswith("_:"):
+                continue
+        if not (p.startswith("<") and p.endswith(">")):
+            continue
+        yield s, p, o, g
+
+
+def run(name, parse, path, repeats):
+    best = None
+    for _ in range(repeats):
+        with open(path, "rb") as F:
+            start_time = time.time()
+            count = 0
+            for _ in parse(F):
+                count += 1
+            duration = time.time() - start_time
+        best = duration if best is None else min(best, duration)
+    with open(path, "rb") as F:
+        lines = sum(1 for _ in F)
+    print(f"{name:10} {count:>12} triples {int(lines / best):>12} lines/sec")
+    return count
+
+
+def main():
+    path = sys.argv[1]
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    stats = new_stats()
+    run("legacy", legacy_parse, path, repeats)
+    run(
+        "tokenizer",
+        lambda F: tokenize_lines(iter_line_batches(F), stats),
+        path,
+        repeats,
+    )
+
+    with open(path, "rb") as A, open(path, "rb") as B:
+        different = sum(
+            1
+            for a, b in zip(legacy_parse(A), tokenize_lines(iter_line_batches(B)))
+            if a != b
+        )
+    print(f"{different} triples differ between the two parsers")
+
+
+if __name__ == "__main__":
+    main()